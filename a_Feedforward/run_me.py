@@ -52,8 +52,21 @@ parser.add_argument('-us', '--upsampling_rate', dest="upsampling_rate", type=int
 parser.add_argument('-ir', '--input_radius', dest="input_radius", type=int, default=5, help='input radius')
 parser.add_argument('--pad_size', type=int, default=-1, help='size of padding applied before patch extraction. Set -1 to apply maximal padding.')
 parser.add_argument('--is_clip', action='store_true', help='want to clip the images (0.1% - 99.9% percentile) before patch extraction? ')
-parser.add_argument('--patch_sampling_opt', type=str, default='default', help='sampling scheme for patche extraction')
+parser.add_argument('--patch_sampling_opt', type=str, default='default', help='sampling scheme for patche extraction: default (uniform), edge or anisotropy (weighted)')
+parser.add_argument('--prefetch', type=int, default=4, help='number of minibatches extracted ahead in background threads. Set 0 to extract synchronously.')
+parser.add_argument('--materialise', type=int, default=0, help='memory budget in MB up to which all the training patches are extracted and whitened once, then sliced into minibatches. Set 0 to extract them for every minibatch.')
+parser.add_argument('--materialise_valid', action='store_true', help='extract the validation patches once and slice the validation minibatches from them?')
+parser.add_argument('--extract_procs', type=int, default=0, help='number of patch extraction processes per minibatch stream, sharing the volumes in memory mapped files. Set 0 to extract in threads instead.')
+parser.add_argument('--seed', type=int, default=None, help='random seed for the minibatch order (reproducible training)')
+parser.add_argument('--num_shards', type=int, default=1, help='number of trainer processes/nodes that split each epoch of the patch library between them (needs --seed)')
+parser.add_argument('--shard', type=int, default=0, help='index of this trainer among the --num_shards ones')
+parser.add_argument('--cache_dir', type=str, default='', help='directory to cache the preprocessed volumes in as memory mapped files. Leave empty to disable.')
 parser.add_argument('--transform_opt', type=str, default='standard', help='normalisation transform')
+parser.add_argument('--stats_samples', type=int, default=10000, help='number of training patches used to compute the normalisation transform. Set 0 to use all of them.')
+parser.add_argument('--manifest', action='store_true', help='take the foreground boxes and clipping percentiles of the subjects from manifest files next to their images (built on first use) instead of scanning the volumes.')
+parser.add_argument('--storage', type=str, default='float32', choices=['float32', 'float16', 'int16'], help='type the preprocessed volumes are held in memory in. float16 or int16 (scaled per channel) halve the memory; the patches are upcast to float32 as they are extracted.')
+parser.add_argument('--streaming', action='store_true', help='draw fresh training patches for each minibatch instead of building a fixed patch library? (the validation patches stay fixed)')
+parser.add_argument('--augment', type=str, default='none', choices=['none', 'flip', 'rotate', 'all'], help='augment the training patches with random flips (flip), 90 degree rotations (rotate) or both (all) of the voxel grid, rotating the diffusion tensors accordingly.')
 parser.add_argument('-pp', '--postprocess', dest='postprocess', action='store_true', help='post-process the estimated highres output?')
 
 
@@ -8,6 +8,7 @@ import cPickle as pkl
 import tensorflow as tf
 import numpy as np
 from common.data_generator import prepare_data
+from common.patch_sampler import Prefetcher
 from common.ops import get_tensor_shape
 from common.sr_utility import get_2dslices, visualise_patches
 from common.utils import name_network, name_patchlib, set_network_config,\
@@ -204,10 +205,36 @@ def train_cnn(opt):
                                          us_rate=opt['upsampling_rate'],
                                          data_dir_root=opt['gt_dir'],
                                          save_dir_root=opt['data_dir'],
-                                         subpath=opt['subpath'])
+                                         subpath=opt['subpath'],
+                                         cache_dir=opt.get('cache_dir', ''),
+                                         stats_samples=opt.get('stats_samples', 10000),
+                                         streaming=opt.get('streaming', False),
+                                         storage=opt.get('storage', 'float32'),
+                                         manifest=opt.get('manifest', False))
     opt['train_noexamples'] = dataset.size
     opt['valid_noexamples'] = dataset.size_valid
 
+    dataset.set_seed(opt.get('seed'))
+    if opt.get('num_shards', 1) > 1:
+        # train on this process' disjoint slice of every epoch:
+        dataset.set_shard(opt['shard'], opt['num_shards'])
+        opt['train_noexamples'] = dataset.shard_size
+    dataset.set_augmentation(opt.get('augment'))
+    if opt.get('materialise', 0) > 0:
+        # slice the minibatches from patches extracted once, if they fit:
+        dataset.materialise(max_memory=opt['materialise'] * 2**20,
+                            valid=opt.get('materialise_valid', False))
+    elif opt.get('materialise_valid', False):
+        dataset.materialise_valid()
+
+    # extract the minibatches in background threads during the training steps:
+    if opt.get('prefetch', 0) > 0:
+        procs = opt.get('extract_procs', 0)
+        dataset = Prefetcher(dataset, opt['batch_size'],
+                             queue_size=opt['prefetch'],
+                             no_workers=procs if procs > 0 else 2,
+                             processes=procs > 0)
+
     # --------------------------- START TRAINING ------------------------------
     print("\n--------------------------")
     print("... Start training! \n")
@@ -274,8 +301,8 @@ def train_cnn(opt):
                 lr_=lr_/ 10.
 
             for mi in xrange(n_train_batches):
-                # Select minibatches using a slice object---consider
-                # multi-threading for speed if this is too slow
+                # Select minibatches (prefetched in the background if
+                # opt['prefetch'] > 0)
 
                 xt, yt = dataset.next_batch(opt['batch_size'])
                 xv, yv = dataset.next_val_batch(opt['batch_size'])
@@ -411,6 +438,8 @@ def train_cnn(opt):
         # close the summary writers:
         train_writer.close()
         valid_writer.close()
+        if isinstance(dataset, Prefetcher):
+            dataset.stop()
 
         # Display the best results:
         print(('\nOptimization complete. Best validation score of %f  '
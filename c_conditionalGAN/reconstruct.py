@@ -360,26 +360,3 @@ def dt_trim(dt_volume, pd):
                           pd[2][0]:-pd[2][1],
                           :]
     return dt_volume
-
-
-# Clip images:
-def clip_image(img, bkgv=0.0, tail_perc=0.1, head_perc=99.9):
-    """ Truncate 3d volume by the specified percentile
-    Assumptions:
-        img is 4d numpy array with last dim being channels e.g. DTI components
-        back ground value is consistently given by bkgv.
-
-    Args:
-    """
-    assert img.ndim == 4
-    brain_mask = img[..., 0] != bkgv # get the foreground voxels
-    for ch_idx in range(img.shape[-1]):
-        v_ch=img[...,ch_idx][brain_mask]
-        inp_perc_tail = np.percentile(v_ch, tail_perc)
-        inp_perc_head = np.percentile(v_ch, head_perc)
-        img[...,ch_idx][brain_mask]=np.clip(v_ch, inp_perc_tail, inp_perc_head)
-    return img
-
-
-
-
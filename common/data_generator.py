@@ -18,8 +18,11 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 import os
+import hashlib
+import multiprocessing.pool
 import common.patch_sampler as patch_sampler
 import common.data_utils as dutils
+import common.subject_manifest as subject_manifest
 
 
 # The main function for define the patch loader:
@@ -42,7 +45,12 @@ def prepare_data(size,
                  us_rate=2,
                  data_dir_root='',
                  save_dir_root='',
-                 subpath=''):
+                 subpath='',
+                 cache_dir='',
+                 stats_samples=10000,
+                 streaming=False,
+                 storage='float32',
+                 manifest=False):
     """
     Data preparation and patch generation for diffusion data.
     Outputs the Data class that provides a next_batch function to call for training.
@@ -77,6 +85,22 @@ def prepare_data(size,
                             patche pairs are extracted.
         save_dir_root (str) : root dir where the patch library or extractor are
                             saved.
+        cache_dir (str) : root dir of the cache of preprocessed volumes. If
+                          set, the preprocessed volumes are stored there as
+                          memory mapped files, and later runs with the same
+                          source files and preprocessing skip loading them.
+                          The foreground voxels of the subjects are cached
+                          there as well (in save_dir_root if not set), and
+                          shared by runs with different patch sizes.
+        stats_samples (int) : number of training patches used to compute the
+                              'standard' whitening transform (<= 0: all)
+        streaming (bool) : only fix the validation patches and draw fresh
+                           training patches for each minibatch
+        storage (str) : type the preprocessed volumes are held in:
+                        'float32', 'float16' or 'int16' (scaled per channel)
+        manifest (bool) : take the foreground boxes and clipping percentiles
+                          of the subjects from their manifests (see
+                          common.subject_manifest), building missing ones
 
     Returns:
         dataset: data_patchlib.Data, which provides a next_batch function
@@ -97,25 +121,49 @@ def prepare_data(size,
     # load the images into memory (as a list of numpy arrays):
     inp_channels = range(3,no_channels+3)
     out_channels = range(3,no_channels+3)
-    inp_images, out_images = load_data(data_dir_root,
-                                       subpath,
-                                       train_index,
-                                       inp_channels,
-                                       out_channels,
-                                       inp_header,
-                                       out_header)
-
-    # Check if there're any nan/inf
-    print ('Sanitising data...')
-    for i in range(len(train_index)):
-        dutils.sanitise_imgdata(inp_images[i])
-        dutils.sanitise_imgdata(out_images[i])
+    volume_cache = None
+    if cache_dir:
+        volume_cache = volume_cache_dir(cache_dir, data_dir_root, subpath,
+                                        train_index,
+                                        inp_channels, out_channels,
+                                        inp_header, out_header,
+                                        inpN, us_rate, pad_size, clip, shuffle,
+                                        storage)
+    # the foreground voxels are cached for any patch size, in the cache or
+    # else next to the patch libraries:
+    index_cache = index_cache_dir(cache_dir or save_dir_root, data_dir_root,
+                                  subpath, train_index,
+                                  inp_channels, out_channels,
+                                  inp_header, out_header,
+                                  us_rate, pad_size, clip, bgval, storage)
+
+    subject_info = None
+    if volume_cache and os.path.isfile(os.path.join(volume_cache, 'volumes.pkl')):
+        # the preprocessed volumes are mapped from the cache instead:
+        inp_images, out_images = None, None
+    else:
+        if manifest:
+            subject_info = subject_manifest.subject_manifests(
+                data_dir_root, subpath, train_index, inp_header, out_header,
+                inp_channels, out_channels)
+        inp_images, out_images = load_data(data_dir_root,
+                                           subpath,
+                                           train_index,
+                                           inp_channels,
+                                           out_channels,
+                                           inp_header,
+                                           out_header)
 
     # Feed the data into patch extractor:
-    patfile = os.path.join(train_folder,'patchlib_indices.pkl')
+    patdir = os.path.join(train_folder,'patchlib_indices')
     transfile = os.path.join(train_folder,'transforms.pkl')
+    if not os.path.isdir(patdir):
+        # patch libraries saved as pickled Data before
+        patfile = os.path.join(train_folder,'patchlib_indices.pkl')
+    else:
+        patfile = patdir
 
-    if os.path.isfile(patfile) and os.path.isfile(transfile) and not is_reset:
+    if os.path.exists(patfile) and os.path.isfile(transfile) and not is_reset:
         print ('Loading patch indices...')
         dataset = patch_sampler.Data().load_patch_indices(patfile,
                                                           transfile,
@@ -126,9 +174,17 @@ def prepare_data(size,
                                                           whiten=whiten,
                                                           pad_size=pad_size,
                                                           clip=clip,
-                                                          shuffle=shuffle)
+                                                          shuffle=shuffle,
+                                                          volume_cache=volume_cache,
+                                                          stats_samples=stats_samples,
+                                                          storage=storage,
+                                                          subject_info=subject_info,
+                                                          index_cache=index_cache)
         print('Save transformation:' + transfile)
         dataset.save_transform(transfile)
+        if patfile != patdir:
+            print ('Converting patch indices:' + patdir)
+            dataset.save_patchlib(patdir)
     else:
         print ('Computing patch library...')
         dataset = patch_sampler.Data().create_patch_lib(size,
@@ -143,9 +199,15 @@ def prepare_data(size,
                                                         method=method,
                                                         pad_size=pad_size,
                                                         clip=clip,
-                                                        shuffle=shuffle)
-        print ('Saving patch indices:' + patfile)
-        dataset.save_patch_indices(patfile)
+                                                        shuffle=shuffle,
+                                                        volume_cache=volume_cache,
+                                                        stats_samples=stats_samples,
+                                                        streaming=streaming,
+                                                        storage=storage,
+                                                        subject_info=subject_info,
+                                                        index_cache=index_cache)
+        print ('Saving patch indices:' + patdir)
+        dataset.save_patchlib(patdir)
         print('Saving transformation:' + transfile)
         dataset.save_transform(transfile)
 
@@ -158,10 +220,16 @@ def load_data(data_dir_root,
               inp_channels,
               out_channels,
               inp_header,
-              out_header):
+              out_header,
+              no_workers=8,
+              max_subjects=4):
     """Load a sequence of nifti files.
 
-    Load a sequence of nifti files, which should be stored in the HCP folder
+    Load a sequence of nifti files, which should be stored in the HCP folder.
+    The images are sanitised (for inf and nan) in place as they are loaded.
+    The channel files are read concurrently in a pool of threads (nibabel
+    and numpy release the GIL for the I/O and the decoding), for up to
+    max_subjects subjects at a time.
 
     Args:
         data_dir_root (str) : root dir for data
@@ -170,20 +238,129 @@ def load_data(data_dir_root,
         out_channels (list of int): for DTI e.g. [3,4,5,6,7,8]
         inp_header (str): header of input nii files e.g. 'dt_b1000_lowres_2_'
         out_header (str): header of output nii files e.g. 'dt_b1000_'
+        no_workers (int): number of threads reading the files
+        max_subjects (int): number of subjects loaded at the same time
 
     Returns:
         inp_images (list): list of numpy arrays
     """
-    print ('Loading data...')
-    inp_images = [0,] * len(train_index)
-    out_images = [0,] * len(train_index)
-    ind = 0
+    print ('Loading and sanitising data...')
+    files = multiprocessing.pool.ThreadPool(max(no_workers, 1))
 
-    for subject in train_index:
+    def load(subject):
         inp_file = os.path.join(data_dir_root, subject, subpath, inp_header)
         out_file = os.path.join(data_dir_root, subject, subpath, out_header)
-        inp_images[ind], hdr = dutils.load_series_nii(inp_file, inp_channels, dtype='float32')
-        out_images[ind], _   = dutils.load_series_nii(out_file, out_channels, dtype='float32')
-        ind += 1
+        inp_image, hdr = dutils.load_series_nii(inp_file, inp_channels,
+                                                dtype='float32', sanitise=True,
+                                                pool=files)
+        out_image, _   = dutils.load_series_nii(out_file, out_channels,
+                                                dtype='float32', sanitise=True,
+                                                pool=files)
+        return inp_image, out_image
+
+    subjects = multiprocessing.pool.ThreadPool(
+        max(min(max_subjects, len(train_index)), 1))
+    try:
+        images = subjects.map(load, train_index)
+    finally:
+        subjects.close()
+        files.close()
+        subjects.join()
+        files.join()
+    inp_images = [inp for inp, _ in images]
+    out_images = [out for _, out in images]
 
     return inp_images, out_images
+
+
+# bumped whenever the layout of the cached volumes changes (2: unshuffled
+# hi-res outputs)
+VOLUME_FORMAT = 2
+
+
+def volume_cache_dir(cache_dir,
+                     data_dir_root,
+                     subpath,
+                     train_index,
+                     inp_channels,
+                     out_channels,
+                     inp_header,
+                     out_header,
+                     inpN,
+                     us_rate,
+                     pad_size,
+                     clip,
+                     shuffle,
+                     storage='float32'):
+    """Cache folder of a set of preprocessed volumes.
+
+    The folder is named by a hash of the preprocessing parameters and of the
+    source nifti files (path, size and modification time), so changing any
+    of them gives a new folder rather than a stale cache.
+
+    Args:
+        cache_dir (str) : root dir of the cache
+        (others): as in load_data and prepare_data
+
+    Returns:
+        volume_cache (str): folder of the preprocessed volumes
+    """
+    key = hashlib.sha1()
+    key.update(repr((VOLUME_FORMAT, inpN, us_rate, pad_size, bool(clip),
+                     bool(shuffle), list(inp_channels),
+                     list(out_channels), str(storage))).encode('utf-8'))
+    _hash_sources(key, data_dir_root, subpath, train_index,
+                  inp_channels, out_channels, inp_header, out_header)
+    return os.path.join(cache_dir, 'volumes_' + key.hexdigest()[:16])
+
+
+def index_cache_dir(cache_dir,
+                    data_dir_root,
+                    subpath,
+                    train_index,
+                    inp_channels,
+                    out_channels,
+                    inp_header,
+                    out_header,
+                    us_rate,
+                    pad_size,
+                    clip,
+                    bgval,
+                    storage='float32'):
+    """Cache folder of the foreground voxels of a set of subjects.
+
+    Unlike the volume cache, the folder does not depend on the patch radius:
+    the voxels are stored in the coordinates of the unpadded low-res inputs,
+    which only depend on the upsampling rate and on where the low-res grid
+    falls, i.e. the padding modulo the upsampling rate (the maximal padding
+    of any radius is a multiple of it).
+
+    Args:
+        cache_dir (str) : root dir of the cache
+        (others): as in load_data and prepare_data
+
+    Returns:
+        index_cache (str): folder of the foreground voxels
+    """
+    phase = 0 if pad_size < 0 else pad_size % us_rate
+    key = hashlib.sha1()
+    key.update(repr((us_rate, phase, bool(clip), float(bgval),
+                     list(inp_channels), list(out_channels),
+                     str(storage))).encode('utf-8'))
+    _hash_sources(key, data_dir_root, subpath, train_index,
+                  inp_channels, out_channels, inp_header, out_header)
+    return os.path.join(cache_dir, 'valid_indices_' + key.hexdigest()[:16])
+
+
+def _hash_sources(key, data_dir_root, subpath, train_index,
+                  inp_channels, out_channels, inp_header, out_header):
+    """ Adds the path, size and modification time of the source files to key """
+    for subject in train_index:
+        for header, channels in ((inp_header, inp_channels),
+                                 (out_header, out_channels)):
+            namepat = os.path.join(data_dir_root, subject, subpath, header)
+            for ch in channels:
+                filename = namepat.format(ch)
+                st = os.stat(filename)
+                key.update(repr((filename, st.st_size,
+                                 int(st.st_mtime))).encode('utf-8'))
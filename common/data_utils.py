@@ -115,7 +115,8 @@ def prog(perc, step, stepval, mesg=''):
 def sanitise_imgdata(imgdat, val=0., neg=False, nan=True, inf=True):
     """
     Removes, negative, nan, inf value voxels from an image and set to the
-    requested value. The change is done in place.
+    requested value. The change is done in place, in a single pass over the
+    image.
 
     Args:
         imgdat (np.ndarray): the image data.
@@ -125,14 +126,166 @@ def sanitise_imgdata(imgdat, val=0., neg=False, nan=True, inf=True):
         inf (bool): if true set all voxels with inf values to val.
 
     """
-    if nan:
-        imgdat[np.isnan(imgdat)] = val
-    if inf:
-        imgdat[np.isinf(imgdat)] = val
+    mask = None
+    if nan and inf:
+        mask = ~np.isfinite(imgdat)
+    elif nan:
+        mask = np.isnan(imgdat)
+    elif inf:
+        mask = np.isinf(imgdat)
     if neg:
-        imgdat[imgdat<0] = val
+        with np.errstate(invalid='ignore'):
+            negative = imgdat < 0
+        mask = negative if mask is None else np.logical_or(mask, negative, out=mask)
+    if mask is not None:
+        np.copyto(imgdat, val, where=mask)
 
 
+def clip_percentiles(img, mask, tail_perc=0.1, head_perc=99.9, bounds=None):
+    """
+    Clips each channel of a 4D image at the given percentiles of its values
+    within mask, in place. Only the masked voxels are changed.
+    The percentiles equal np.percentile's (linear interpolation), but the
+    masked values are gathered once for all channels, each channel is
+    searched in a single pass (see order_statistics), and only the clipped
+    voxels are written.
+
+    Args:
+        img (np.ndarray): 4D image, channels last
+        mask (np.ndarray): 3D boolean mask of the voxels to use and clip
+        tail_perc (float): lower percentile
+        head_perc (float): upper percentile
+        bounds (tuple): precomputed (tails, heads) of the image (see
+                        mask_percentiles), which are then not searched for
+
+    Returns:
+        tails, heads (np.ndarray): lower and upper percentile of each channel
+    """
+    coords = np.nonzero(mask)
+    vals = np.ascontiguousarray(img[coords].T)  # (channels, no. voxels)
+    if vals.shape[1] == 0:
+        return None, None
+    if bounds is None:
+        bounds = _percentiles(vals, tail_perc, head_perc)
+    tails, heads = [np.asarray(b, dtype=np.float64) for b in bounds]
+    for ch_idx in range(vals.shape[0]):
+        # only the few voxels outside the percentiles are written back:
+        tail, head = tails[ch_idx], heads[ch_idx]
+        for rows, val in ((np.flatnonzero(vals[ch_idx] < tail), tail),
+                          (np.flatnonzero(vals[ch_idx] > head), head)):
+            img[coords[0][rows], coords[1][rows], coords[2][rows], ch_idx] = val
+    return tails, heads
+
+
+def mask_percentiles(img, mask, tail_perc=0.1, head_perc=99.9):
+    """
+    Percentiles of each channel of a 4D image within mask, as used by
+    clip_percentiles (which this does not clip).
+
+    Returns:
+        tails, heads (np.ndarray): lower and upper percentile of each
+                                   channel, None if the mask is empty
+    """
+    vals = np.ascontiguousarray(img[np.nonzero(mask)].T)
+    if vals.shape[1] == 0:
+        return None, None
+    return _percentiles(vals, tail_perc, head_perc)
+
+
+def _percentiles(vals, tail_perc, head_perc):
+    """ np.percentile-like tail/head percentiles of each row of vals """
+    n = vals.shape[1]
+    pos = [(n - 1) * perc / 100. for perc in (tail_perc, head_perc)]
+    ranks = []
+    for p in pos:
+        ranks += [int(np.floor(p)), min(int(np.floor(p)) + 1, n - 1)]
+    percs = np.empty((2, vals.shape[0]))
+    for ch_idx in range(vals.shape[0]):
+        stats = order_statistics(vals[ch_idx], ranks)
+        for idx, p in enumerate(pos):
+            lo, v_lo, v_hi = ranks[2*idx], stats[2*idx], stats[2*idx + 1]
+            percs[idx, ch_idx] = v_lo + (p - lo) * (v_hi - v_lo)
+    tails, heads = percs
+    return tails, heads
+
+
+def nonzero_box(*images):
+    """
+    Bounding box of the voxels that are non-zero in any channel of any of
+    the images (of the same spatial shape).
+
+    Returns:
+        start, stop (np.ndarray): the box spans start to stop (exclusive)
+                                  along each axis; the whole image if all
+                                  its voxels are zero
+    """
+    shape = images[0].shape[:3]
+    nonzero = np.zeros(shape, dtype=bool)
+    for img in images:
+        if img.shape[:3] != shape:
+            raise ValueError('Images of shapes %s and %s do not match'
+                             % (shape, img.shape[:3]))
+        nz = img != 0
+        nonzero |= nz.any(axis=3) if nz.ndim == 4 else nz
+    if not nonzero.any():
+        return np.zeros(3, dtype=np.intp), np.array(shape, dtype=np.intp)
+    start, stop = [], []
+    for axis in range(3):
+        others = tuple(a for a in range(3) if a != axis)
+        idx = np.flatnonzero(nonzero.any(axis=others))
+        start.append(idx[0])
+        stop.append(idx[-1] + 1)
+    return np.array(start, dtype=np.intp), np.array(stop, dtype=np.intp)
+
+
+def order_statistics(vals, ranks, sample_size=10000, tail_frac=0.01):
+    """
+    Values of the given (0-based) ranks in the sorted 1D array vals.
+    Ranks in the tails (e.g. of the 0.1 and 99.9% percentiles) are
+    selected among the few values beyond a threshold that is estimated on
+    a subsample, which is much faster than partitioning all the values.
+    The result is exact: if the threshold leaves too few values, the ranks
+    are selected with np.partition instead.
+
+    Args:
+        vals (np.ndarray): 1D array
+        ranks (list): ranks in [0, vals.size)
+        sample_size (int): size of the subsample
+        tail_frac (float): fraction of vals regarded as a tail
+
+    Returns:
+        stats (np.ndarray): float64 values of the ranks
+    """
+    n = vals.size
+    ranks = np.asarray(ranks)
+    stats = np.empty(ranks.shape)
+    todo = np.ones(ranks.shape, dtype=bool)
+    step = n // sample_size
+    if step > 1:
+        sample = np.sort(vals[::step])
+        m = sample.size
+        low = ranks < tail_frac * n
+        high = n - 1 - ranks < tail_frac * n
+        if np.any(low):
+            # the smallest values: keep twice as many as expected, plus some
+            r = ranks[low].max()
+            thres = sample[min(2 * (r + 1) // step + 8, m - 1)]
+            cand = vals[vals <= thres]
+            if cand.size > r:
+                stats[low] = np.partition(cand, ranks[low])[ranks[low]]
+                todo[low] = False
+        if np.any(high):
+            q = n - 1 - ranks[high]  # ranks from the top
+            thres = sample[max(m - 1 - 2 * (q.max() + 1) // step - 8, 0)]
+            cand = vals[vals >= thres]
+            if cand.size > q.max():
+                k = cand.size - 1 - q
+                stats[high] = np.partition(cand, k)[k]
+                todo[high] = False
+    if np.any(todo):
+        stats[todo] = np.partition(vals, ranks[todo])[ranks[todo]]
+    return stats
+
 
 def show_slices(slices, sz=0, sz_2=0, figsize=(6,6)):
     """ Function to display row of image slices
@@ -158,6 +311,10 @@ def image_subsample(dat, mask, ds=2, bgval=0):
     """
     Subsamples the image by average ds voxels. Retains the original
     resolution of the input image. Subsampling is done in place.
+    Each voxel in the mask whose whole block [i, i+ds) x [j, j+ds) x
+    [k, k+ds) (truncated at the borders) is in the mask is replaced by the
+    mean of the block; for 4D images the mean is over all the channels of
+    the block. The block means come from cumulative sums, not per voxel.
 
     Args:
         dat (np.ndarray): 3D or 4D image.
@@ -166,20 +323,11 @@ def image_subsample(dat, mask, ds=2, bgval=0):
         bgval (float): background value outside mask.
 
     """
-    ijk = np.argwhere(mask!=bgval)
-    cop = np.copy(dat)
-    if len(dat.shape)==3:
-        for i,j,k in ijk:
-            bmask = mask[i:(i+ds),j:(j+ds),k:(k+ds)]
-            if bgval not in bmask:
-                dat[i,j,k]=np.mean(cop[i:(i+ds),j:(j+ds),k:(k+ds)])
-    elif len(dat.shape)==4:
-        for i,j,k in ijk:
-            bmask = mask[i:(i+ds),j:(j+ds),k:(k+ds)]
-            if bgval not in bmask:
-                dat[i,j,k,:]=np.mean(cop[i:(i+ds),j:(j+ds),k:(k+ds),:])
-    else:
+    if dat.ndim not in (3, 4):
         raise ValueError('Only 3D or 4D images are handled')
+    outside = _box_sum(mask == bgval, ds)
+    sel = (mask != bgval) & (outside == 0)
+    dat[sel] = _block_means(dat, ds)[sel][(Ellipsis,) + (np.newaxis,) * (dat.ndim - 3)]
 
 
 
@@ -187,6 +335,8 @@ def image_subsample2(dat, mask, ds=2, bgval=0):
     """
     Subsamples the image by average ds voxels. Retains the original
     resolution of the input image. Subsampling is done in place.
+    Unlike image_subsample, every voxel in the mask is replaced by the mean
+    of its block, also if the block reaches outside the mask.
 
     Args:
         dat (np.ndarray): 3D or 4D image.
@@ -195,23 +345,51 @@ def image_subsample2(dat, mask, ds=2, bgval=0):
         bgval (float): background value outside mask.
 
     """
-    ijk = np.argwhere(mask!=bgval)
-    cop = np.copy(dat)
-    if len(dat.shape)==3:
-        for i,j,k in ijk:
-            dat[i,j,k]=np.mean(cop[i:(i+ds),j:(j+ds),k:(k+ds)])
-    elif len(dat.shape)==4:
-        for i,j,k in ijk:
-            dat[i,j,k,:]=np.mean(cop[i:(i+ds),j:(j+ds),k:(k+ds),:])
-    else:
+    if dat.ndim not in (3, 4):
         raise ValueError('Only 3D or 4D images are handled')
+    sel = mask != bgval
+    dat[sel] = _block_means(dat, ds)[sel][(Ellipsis,) + (np.newaxis,) * (dat.ndim - 3)]
+
 
+def _block_means(dat, ds):
+    """ Means of dat over the block at each voxel (see _box_sum) and all channels """
+    vol = dat.sum(axis=3, dtype=np.float64) if dat.ndim == 4 else dat
+    count = np.ones(vol.shape[:3])
+    for axis in range(3):
+        n = vol.shape[axis]
+        length = np.minimum(np.arange(n) + ds, n) - np.arange(n)
+        count = count * length.reshape([-1 if a == axis else 1 for a in range(3)])
+    if dat.ndim == 4:
+        count *= dat.shape[3]
+    return _box_sum(vol, ds) / count
 
 
-def load_series_nii(namepat, series=[], dtype='float32'):
+def _box_sum(vol, ds):
+    """
+    Sums of the 3D vol over the blocks [i, i+ds) x [j, j+ds) x [k, k+ds),
+    truncated at the borders, as differences of cumulative sums
+    """
+    total = vol
+    for axis in range(3):
+        n = total.shape[axis]
+        shape = list(total.shape)
+        shape[axis] = 1
+        csum = np.concatenate([np.zeros(shape), np.cumsum(total, axis=axis,
+                                                          dtype=np.float64)],
+                              axis=axis)
+        total = (np.take(csum, np.minimum(np.arange(n) + ds, n), axis=axis)
+                 - np.take(csum, np.arange(n), axis=axis))
+    return total
+
+
+
+def load_series_nii(namepat, series=[], dtype='float32', sanitise=False,
+                    pool=None):
     """
     Loads a series of NIFTI files. For example:
         file_01.nii, file_02.nii ...
+    Each file is read straight into its channel of the preallocated output,
+    so no intermediate copy of the whole series is made.
 
     Args:
         namepat (string): Generic file name with format pattern
@@ -220,6 +398,10 @@ def load_series_nii(namepat, series=[], dtype='float32'):
                             filename = namepat.format(i)
                         if series=[], assumes namepat is the filename (single image).
         dtype (string): default float32 (GPU)
+        sanitise (bool): if true, nan/inf voxels are set to zero in place
+                         (see sanitise_imgdata) as each file is loaded
+        pool (ThreadPool): optional pool the files after the first one are
+                           read in concurrently
 
     Returns:
         img (np.array): image array with series loaded in the 4th dim
@@ -229,37 +411,56 @@ def load_series_nii(namepat, series=[], dtype='float32'):
     if not series:
         print ('Loading:', namepat)
         nii = nib.load(namepat)
-        img = nii.get_data().astype(dtype)
+        img = np.empty(nii.shape, dtype=dtype)
+        load_nii_into(nii, img, sanitise=sanitise)
         hdr = nii.get_header()
     elif len(series) == 1:
         filename = namepat.format(series[0])
         print ('Loading single channel:', filename)
         nii = nib.load(filename)
-        img = nii.get_data().astype(dtype)
+        img = np.empty(nii.shape, dtype=dtype)
+        load_nii_into(nii, img, sanitise=sanitise)
         hdr = nii.get_header()
     else:
         filename = namepat.format(series[0])
         print ('Loading:', filename, 0)
         nii = nib.load(filename)
-        dat = nii.get_data().astype(dtype)
         hdr = nii.get_header()
-        shplen = len(dat.shape)
-        shape = [0,] * (shplen + 1)
-        for i in range(shplen):
-            shape[i] = dat.shape[i]
-        shape[shplen] = len(series)
-        img = np.zeros(shape)
-        img[..., 0] = dat
-        cnt = 1
-        for i in series[1:]:
-            filename = namepat.format(i)
+        img = np.empty(nii.shape + (len(series),), dtype=dtype)
+        load_nii_into(nii, img[..., 0], sanitise=sanitise)
+
+        def load(cnt):
+            filename = namepat.format(series[cnt])
             print ('Loading:', filename, cnt)
-            nii = nib.load(filename)
-            img[..., cnt] = nii.get_data().astype(dtype)
-            cnt += 1
+            load_nii_into(nib.load(filename), img[..., cnt], sanitise=sanitise)
+
+        if pool is None:
+            for cnt in range(1, len(series)):
+                load(cnt)
+        else:
+            pool.map(load, range(1, len(series)))
     return img, hdr
 
 
+def load_nii_into(nii, out, sanitise=False):
+    """
+    Reads the data of a (loaded) NIFTI image into the array out, e.g. one
+    channel of a 4D volume, converting it to the type of out on the fly.
+    The data is not cached in the nibabel image.
+
+    Args:
+        nii (nibabel image): image returned by nib.load
+        out (np.ndarray): preallocated array of the same shape
+        sanitise (bool): if true, set nan/inf voxels of out to zero
+    """
+    if tuple(nii.shape) != out.shape:
+        raise ValueError('Image of shape %s does not fit into %s'
+                         % (nii.shape, out.shape))
+    out[...] = np.asanyarray(nii.dataobj)
+    if sanitise:
+        sanitise_imgdata(out)
+
+
 
 def write_series_nii(namepat, img, hdr=None, series=[], dtype='float32'):
     """
@@ -329,40 +530,100 @@ def logdir_reset(log_dir):
 
 
 
-def block_match(inp, out):
+def block_match(inp, out, normalise=True):
     """
     Block matching algorithm for an output patch within a larger
-    input patch
-    """
-    sh1 = inp.shape
-    sh2 = out.shape
-    inpN = (sh1[0] - 1) // 2
-    if np.linalg.norm(inp)==0 or np.linalg.norm(out)==0:
-        ind = np.array([0, 0, 0])
-        MI = np.zeros((sh1[0]-sh2[0]+1, sh1[1]-sh2[1]+1, sh1[2]-sh2[2]+1))
-    else:
-        outM = (sh2[0] - 1) // 2
-        MI = np.array([[[mu.MI(inp[i-outM:i+outM+1, j-outM:j+outM+1, k-outM:k+outM+1], out)
-                      for k in range(outM, sh1[2]-outM)]
-                      for j in range(outM, sh1[1]-outM)]
-                      for i in range(outM, sh1[0]-outM)])
-        #MI2 = np.zeros((sh1[0]-sh2[0]+1, sh1[1]-sh2[1]+1, sh1[2]-sh2[2]+1))
-        #for i in range(outM, sh1[0]-outM):
-        #    for j in range(outM, sh1[1]-outM):
-        #        for k in range(outM, sh1[2]-outM):
-        #            MI2[i-outM, j-outM, k-outM] = mu.MI(inp[i-outM:i+outM+1, j-outM:j+outM+1, k-outM:k+outM+1], out)
-        #print (np.linalg.norm(MI-MI2))
-        ind = np.argmax(MI)
-        ind = np.unravel_index(ind, MI.shape)
-        ind = np.array(ind) - inpN + outM
-    return ind, MI
+    input patch. Every position of the output patch is scored at once by
+    FFT cross-correlation (see block_match_batch).
+
+    Args:
+        inp (np.ndarray): 3D (or 4D, with channels) input patch
+        out (np.ndarray): smaller output patch, with the same channels
+        normalise (bool): score by normalised cross-correlation rather
+                          than by plain cross-correlation
+
+    Returns:
+        ind (np.ndarray): offset of the best match from the input centre
+        scores (np.ndarray): scores of all the positions
+    """
+    ind, scores = block_match_batch(inp[np.newaxis], out[np.newaxis],
+                                    normalise=normalise)
+    return ind[0], scores[0]
+
+
+def block_match_batch(inps, outs, normalise=True):
+    """
+    Block matching of a batch of output patches within the input patches.
+    The scores of all the positions are computed at once with FFTs; the
+    channels are summed over. Pairs where either patch is all zero score 0
+    everywhere and get offset 0.
+
+    Args:
+        inps (np.ndarray): (N, X, Y, Z) or (N, X, Y, Z, C) input patches
+        outs (np.ndarray): (N, x, y, z) or (N, x, y, z, C) output patches,
+                           no larger than the input patches
+        normalise (bool): score by normalised cross-correlation (in [-1, 1])
+                          rather than by plain cross-correlation
+
+    Returns:
+        inds (np.ndarray): (N, 3) offsets of the best matches from the
+                           centres of the input patches
+        scores (np.ndarray): (N, X-x+1, Y-y+1, Z-z+1) scores of all the
+                             positions
+    """
+    if inps.ndim == 4:
+        inps, outs = inps[..., np.newaxis], outs[..., np.newaxis]
+    if inps.ndim != 5 or outs.ndim != 5 or inps.shape[0] != outs.shape[0] \
+            or inps.shape[4] != outs.shape[4]:
+        raise ValueError('Incompatible patch batches of shapes %s and %s'
+                         % (inps.shape, outs.shape))
+    sh1 = np.array(inps.shape[1:4])
+    sh2 = np.array(outs.shape[1:4])
+    if np.any(sh2 > sh1):
+        raise ValueError('The output patches are larger than the input ones.')
+    n = inps.shape[0]
+    fsize = tuple(sh1)
+    valid = (slice(None),) + tuple(slice(0, d) for d in sh1 - sh2 + 1)
+
+    def correlate(fa, b):
+        # valid cross-correlation: no wrap-around as the FFT size is sh1
+        fb = np.fft.rfftn(b, s=fsize, axes=(1, 2, 3))
+        return np.fft.irfftn(fa * np.conj(fb), s=fsize, axes=(1, 2, 3))[valid]
+
+    inps = inps.astype(np.float64)
+    outs = outs.astype(np.float64)
+    empty = ~(np.any(inps != 0, axis=(1, 2, 3, 4)) &
+              np.any(outs != 0, axis=(1, 2, 3, 4)))
+    if normalise:
+        outs = outs - outs.mean(axis=(1, 2, 3, 4), keepdims=True)
+    finp = np.fft.rfftn(inps, axes=(1, 2, 3))
+    scores = correlate(finp, outs).sum(axis=4)
+    if normalise:
+        # local sums of the input (and its square) under the output patch
+        ones = np.ones((1,) + tuple(sh2) + (1,))
+        size = float(np.prod(sh2) * inps.shape[4])
+        sum1 = correlate(finp, ones).sum(axis=4)
+        sum2 = correlate(np.fft.rfftn(inps**2, axes=(1, 2, 3)), ones).sum(axis=4)
+        var_inp = sum2 - sum1**2 / size
+        var_out = np.sum(outs**2, axis=(1, 2, 3, 4))
+        var_out = var_out[:, np.newaxis, np.newaxis, np.newaxis]
+        # constant windows (up to round-off) are not correlated with anything
+        flat = (var_inp <= 1e-10 * sum2) | (var_out == 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scores = np.where(flat, 0, scores / np.sqrt(var_inp * var_out))
+
+    scores[empty] = 0
+    flat = np.argmax(scores.reshape(n, -1), axis=1)
+    inds = np.transpose(np.unravel_index(flat, scores.shape[1:])) - (sh1 - sh2) // 2
+    inds[empty] = 0
+    return inds, scores
 
 
 
 def backward_shuffle_img(imglist, ds):
     """
     Bring hi-res image to low-res dimension through reverse/backward shuffling.
-    Shuffling done in place.
+    Each image is shuffled into a new array (see backward_shuffle_batch).
 
     Args:
         imglist (list): List of images to shuffle
@@ -372,32 +633,17 @@ def backward_shuffle_img(imglist, ds):
         shuff_images (list): reverse shuffled images
     """
     print ('Reverse shuffling hi-res images')
-
-    shuffle_indices = [(i, j, k) for k in range(ds)
-                                 for j in range(ds)
-                                 for i in range(ds)]
-    is3D = True
-    channelsN = 1
-    if len(imglist[0].shape) == 3:
-        pass
-    elif len(imglist[0].shape) == 4:
-        channelsN = imglist[0].shape[3]
-        is3D = False
-    else:
+    if len(imglist[0].shape) not in (3, 4):
         raise ValueError('Only 3D or 4D images handled.')
 
     shuff_images = []
     for img in imglist:
-        shuff_arrays = []
-        if is3D:
-            for (i, j, k) in shuffle_indices:
-                shuff_arrays.append(img[i::ds, j::ds, k::ds])
-        else:
-            for c in range(channelsN):
-                for (i, j, k) in shuffle_indices:
-                    shuff_arrays.append(img[i::ds, j::ds, k::ds, c])
-        img = np.stack(shuff_arrays, axis=3)
-        shuff_images.append(img)
+        if img.ndim == 3:
+            img = img[..., np.newaxis]
+        # the voxels beyond a multiple of ds are dropped
+        sh = [(n // ds) * ds for n in img.shape[:3]]
+        img = img[:sh[0], :sh[1], :sh[2]]
+        shuff_images.append(backward_shuffle_batch(img[np.newaxis], ds)[0])
 
     return shuff_images
 
@@ -405,7 +651,7 @@ def backward_shuffle_img(imglist, ds):
 def forward_shuffle_img(imglist, us):
     """
     Bring low-res multi-channel images to hi-res dimension through forward
-    shuffling. Shuffling done in place.
+    shuffling (see forward_shuffle_batch).
 
     Args:
         imglist (list): List of images to shuffle
@@ -417,27 +663,68 @@ def forward_shuffle_img(imglist, us):
 
     assert len(imglist[0].shape) == 4
     print ('Forward shuffling shuffled images')
-    N = imglist[0].shape[3]
-    if (N % (us**3)) > 0:
-        raise ValueError('Incompatible number of shuffled layers for upsampling')
-
-    channelsN = N // (us**3)
-    shuffle_indices = [(i, j, k) for k in range(us)
-                                 for j in range(us)
-                                 for i in range(us)]
     shuff_images = []
     for img in imglist:
-        sh = img.shape
-        newsh = (sh[0]*us, sh[1]*us, sh[2]*us, channelsN)
-        img2 = np.zeros(newsh).astype('float32')
-        for c in range(channelsN):
-            for cnt, (i, j, k) in enumerate(shuffle_indices):
-                img2[i::us, j::us, k::us, c] = img[..., c*(us**3) + cnt]
-        shuff_images.append(img2)
+        out = np.empty((1,) + tuple(n * us for n in img.shape[:3]) +
+                       (img.shape[3] // us**3,), dtype='float32')
+        shuff_images.append(forward_shuffle_batch(img[np.newaxis], us, out=out)[0])
 
     return shuff_images
 
 
+def backward_shuffle_batch(batch, ds, out=None):
+    """
+    Reverse periodic shuffling of a batch of hi-res images (or patches)
+    with a single reshape/transpose copy: hi-res voxel
+    (ds*X + i, ds*Y + j, ds*Z + k) of channel c goes to low-res voxel
+    (X, Y, Z), channel c*ds**3 + (k*ds + j)*ds + i.
+
+    Args:
+        batch (np.ndarray): (N, ds*X, ds*Y, ds*Z, C) array
+        ds (int): Downsample/Upsample rate
+        out (np.ndarray): optional (N, X, Y, Z, C*ds**3) output array
+
+    Returns:
+        out (np.ndarray): the shuffled batch
+    """
+    n, dx, dy, dz, c = batch.shape
+    if dx % ds or dy % ds or dz % ds:
+        raise ValueError('Image size is not divisible by the shuffling rate.')
+    view = batch.reshape((n, dx // ds, ds, dy // ds, ds, dz // ds, ds, c))
+    view = view.transpose(0, 1, 3, 5, 7, 6, 4, 2)
+    shape = (n, dx // ds, dy // ds, dz // ds, c * ds**3)
+    if out is None:
+        return np.ascontiguousarray(view).reshape(shape)
+    out.reshape(view.shape)[...] = view
+    return out
+
+
+def forward_shuffle_batch(batch, us, out=None):
+    """
+    Forward periodic shuffling of a batch of low-res images (or patches),
+    the inverse of backward_shuffle_batch.
+
+    Args:
+        batch (np.ndarray): (N, X, Y, Z, C*us**3) array
+        us (int): Downsample/Upsample rate
+        out (np.ndarray): optional (N, us*X, us*Y, us*Z, C) output array
+
+    Returns:
+        out (np.ndarray): the shuffled batch
+    """
+    n, dx, dy, dz, nc = batch.shape
+    if nc % us**3:
+        raise ValueError('Incompatible number of shuffled layers for upsampling')
+    c = nc // us**3
+    view = batch.reshape((n, dx, dy, dz, c, us, us, us))
+    view = view.transpose(0, 1, 7, 2, 6, 3, 5, 4)
+    shape = (n, dx * us, dy * us, dz * us, c)
+    if out is None:
+        return np.ascontiguousarray(view).reshape(shape)
+    out.reshape(view.shape)[...] = view
+    return out
+
+
 def fetch_subjects(no_subjects=8, shuffle=False, test=False):
     if test:
         subj_list = ['904044', '165840', '889579', '713239',
@@ -0,0 +1,147 @@
+"""Generates the low-res training inputs of a set of subjects.
+
+For each subject the hi-res channel files (e.g. dt_b1000_{3..8}.nii) are
+block averaged at the upsampling rate (see data_utils.image_subsample) and
+written next to them as the low-res inputs the patch library is built from
+(e.g. dt_b1000_lowres_2_{3..8}.nii). The low-res images keep the hi-res
+voxel grid. Subjects are processed in parallel in a pool of processes.
+
+Example, run from the repository root:
+    python -m common.make_lowres --data_dir /SAN/vision/hcp/DCA_HCP.2013.3_Proc \
+        --subjects subjects.txt -us 2 --header 'dt_b1000_{:d}.nii' --channels 3 8
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import argparse
+import multiprocessing
+import os
+import numpy as np
+import common.data_utils as dutils
+
+
+def lowres_name(header, us_rate):
+    """Name pattern of the low-res files of a hi-res one.
+
+    Args:
+        header (str): hi-res name pattern e.g. 'dt_b1000_{:d}.nii'
+        us_rate (int): upsampling rate
+
+    Returns:
+        name (str): e.g. 'dt_b1000_lowres_2_{:d}.nii'
+    """
+    if '{' not in header:
+        raise ValueError('The header must have a format field for the channel: '
+                         + header)
+    return header.replace('{', 'lowres_%d_{' % us_rate, 1)
+
+
+def read_manifest(filename):
+    """Subject ids listed in a text file, one per line ('#' starts a comment)."""
+    subjects = []
+    with open(filename, 'r') as handle:
+        for line in handle:
+            line = line.split('#', 1)[0].strip()
+            if line:
+                subjects.append(line)
+    return subjects
+
+
+def make_lowres(subject, data_dir, subpath, header, channels, us_rate,
+                mask_header='', bgval=0, overwrite=False):
+    """Generates the low-res images of one subject.
+
+    Args:
+        subject (str): subject id, a folder in data_dir
+        data_dir (str): root dir of the subjects
+        subpath (str): subdirectory of the images in each subject's folder
+        header (str): name pattern of the hi-res channel files
+        channels (list): channel indices to format the header with
+        us_rate (int): upsampling rate
+        mask_header (str): optional file name of the brain mask. By default
+                           the mask is the voxels non-zero in any channel.
+        bgval (float): background value of the mask file
+        overwrite (bool): regenerate low-res files that exist already
+
+    Returns:
+        subject (str): the subject id, once its files are written
+    """
+    subject_dir = os.path.join(data_dir, subject, subpath)
+    out_pat = os.path.join(subject_dir, lowres_name(header, us_rate))
+    if not overwrite and all(os.path.isfile(out_pat.format(ch))
+                             for ch in channels):
+        print('Low-res images exist already: ' + subject)
+        return subject
+
+    img, hdr = dutils.load_series_nii(os.path.join(subject_dir, header),
+                                      list(channels), dtype='float32',
+                                      sanitise=True)
+    if img.ndim == 3:
+        img = img[..., np.newaxis]
+    if mask_header:
+        mask, _ = dutils.load_series_nii(os.path.join(subject_dir, mask_header),
+                                         dtype='float32', sanitise=True)
+        mask = (mask != bgval).astype('float32')
+    else:
+        mask = np.any(img != 0, axis=3).astype('float32')
+
+    # each channel is averaged on its own:
+    for ch in range(img.shape[3]):
+        dutils.image_subsample(img[..., ch], mask, ds=us_rate, bgval=0)
+    dutils.write_series_nii(out_pat, img, hdr=hdr, series=list(channels),
+                            dtype='float32')
+    return subject
+
+
+def _make_lowres(args):
+    # module level, so that the pool can pickle it
+    subject, kwargs = args
+    return make_lowres(subject, **kwargs)
+
+
+def make_lowres_all(subjects, no_workers=4, **kwargs):
+    """Generates the low-res images of several subjects in a pool of processes.
+
+    Args:
+        subjects (list): subject ids
+        no_workers (int): number of processes
+        kwargs: the other arguments of make_lowres
+    """
+    jobs = [(subject, kwargs) for subject in subjects]
+    if no_workers <= 1 or len(subjects) <= 1:
+        for job in jobs:
+            _make_lowres(job)
+        return
+    pool = multiprocessing.Pool(min(no_workers, len(subjects)))
+    try:
+        for subject in pool.imap_unordered(_make_lowres, jobs):
+            print('Done: ' + subject)
+    finally:
+        pool.close()
+        pool.join()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='generate the low-res training inputs')
+    parser.add_argument('--data_dir', type=str, default='/SAN/vision/hcp/DCA_HCP.2013.3_Proc', help='root directory of the subjects')
+    parser.add_argument('--subpath', type=str, default='T1w/Diffusion', help='subdirectory in each subject folder')
+    parser.add_argument('--subjects', type=str, required=True, help='manifest file listing the subject ids, one per line')
+    parser.add_argument('-us', '--upsampling_rate', dest='upsampling_rate', type=int, default=2, help='upsampling rate')
+    parser.add_argument('--header', type=str, default='dt_b1000_{:d}.nii', help='name pattern of the hi-res channel files, e.g. h4_all_{:02d}.nii for MAP-MRI')
+    parser.add_argument('--channels', type=int, nargs=2, default=[3, 8], help='first and last channel index')
+    parser.add_argument('--mask_header', type=str, default='', help='file name of the brain mask. Leave empty to use the voxels non-zero in any channel.')
+    parser.add_argument('-bgval', '--background_value', dest='background_value', type=float, default=0, help='background value of the mask')
+    parser.add_argument('--no_workers', type=int, default=4, help='number of subjects processed in parallel')
+    parser.add_argument('--overwrite', action='store_true', help='regenerate existing low-res files')
+    arg = parser.parse_args()
+
+    make_lowres_all(read_manifest(arg.subjects),
+                    no_workers=arg.no_workers,
+                    data_dir=arg.data_dir,
+                    subpath=arg.subpath,
+                    header=arg.header,
+                    channels=list(range(arg.channels[0], arg.channels[1] + 1)),
+                    us_rate=arg.upsampling_rate,
+                    mask_header=arg.mask_header,
+                    bgval=arg.background_value,
+                    overwrite=arg.overwrite)
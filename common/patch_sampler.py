@@ -4,10 +4,21 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import os
 import sys
+import json
+import atexit
+import weakref
+import shutil
+import tempfile
+import threading
+import multiprocessing
+import multiprocessing.pool
+import multiprocessing.sharedctypes
 import numpy as np
 import cPickle as pickle
 import copy
+import itertools
 import common.data_utils as du
 # import largesc.math_utils as mu
 # import data_whiten as dwh
@@ -19,6 +30,298 @@ class ScaleParams(object):
     pass
 
 
+class VolumeStore(object):
+    """
+    Subject volumes packed back to back into one contiguous 1D buffer.
+
+    Patches are gathered for a whole minibatch at once with np.take over
+    precomputed flat voxel offsets, straight into a (preallocated) batch
+    buffer, instead of being sliced out one patch at a time. Each voxel is
+    taken as one record holding all of its channels.
+    Volumes are held as 4D arrays; 3D images get a singleton channel axis.
+    A store can be moved into a memory mapped file (see share) to be used
+    by several extraction processes.
+
+    The zero padding of the volumes can be virtual (see layout): patch
+    centres are given in the coordinates of the padded volumes, and the
+    voxels of a patch outside the stored volume are gathered from a single
+    zero voxel at the end of the buffer.
+    Hi-res volumes are stored unshuffled; the reverse periodic shuffle is
+    applied to each gathered batch instead (see gather).
+    To fit more subjects in memory the volumes can be stored as float16, or
+    as integers with one scale per channel, and are upcast to float32 in
+    the gather only.
+    """
+    def __init__(self, images, dtype='float32', layout=None):
+        """
+        Args:
+            images (list): 3D or 4D subject volumes. The entries are released
+                           as they are copied in, so the list is consumed.
+            dtype (str): storage type of the packed volumes. For an integer
+                         type (e.g. 'int16') each channel is scaled to the
+                         range of the type, see scales.
+            layout (tuple): (pads, dims) of the virtual zero padding: the
+                            offset of each stored volume in its padded volume
+                            and the spatial shape of the latter. None if the
+                            volumes are not padded (further).
+        """
+        shapes = []
+        for img in images:
+            if img.ndim == 3:
+                shapes.append(img.shape + (1,))
+            elif img.ndim == 4:
+                shapes.append(img.shape)
+            else:
+                raise ValueError('Only 3D or 4D images handled.')
+        if len(set(sh[3] for sh in shapes)) > 1:
+            raise ValueError('All volumes must have the same number of channels.')
+
+        sizes = [int(np.prod(sh)) for sh in shapes]
+        self._offsets = np.cumsum([0] + sizes[:-1]).astype(np.intp)
+        self._voxel_offsets = self._offsets // shapes[0][3]
+        self._shapes = np.array(shapes, dtype=np.intp)
+        if layout is None:
+            self._pads = np.zeros((len(shapes), 3), dtype=np.intp)
+            self._dims = self._shapes[:, :3].copy()
+        else:
+            self._pads = np.array(layout[0], dtype=np.intp).reshape(-1, 3)
+            self._dims = np.array(layout[1], dtype=np.intp).reshape(-1, 3)
+        self._scales = None
+        if np.dtype(dtype).kind in 'iu':
+            # per channel scale mapping the largest magnitude to the type's max
+            maxabs = np.zeros(shapes[0][3])
+            for img, sh in zip(images, shapes):
+                flat = img.reshape(-1, sh[3])
+                if flat.shape[0] > 0:
+                    maxabs = np.maximum(maxabs, np.abs(flat).max(axis=0))
+            maxabs[maxabs == 0] = 1.
+            self._scales = (maxabs / np.iinfo(dtype).max).astype('float32')
+
+        # the packed volumes, followed by one zero voxel:
+        self._zero_index = sum(sizes) // shapes[0][3]
+        data = np.empty(sum(sizes) + shapes[0][3], dtype=dtype)
+        data[sum(sizes):] = 0
+        for idx, sh in enumerate(shapes):
+            start = self._offsets[idx]
+            vol = images[idx].reshape(sh)
+            if self._scales is not None:
+                vol = np.rint(vol / self._scales)
+            data[start:start + sizes[idx]].reshape(sh)[...] = vol
+            images[idx] = vol = None
+
+        # volumes of equal shape share the same offset templates:
+        uniq = sorted(set(shapes))
+        self._shape_ids = np.array([uniq.index(sh) for sh in shapes], dtype=np.intp)
+        self._uniq_shapes = uniq
+        self._filename = None
+        self._bind(data)
+
+    def _bind(self, data):
+        """ Sets the packed buffer and the views into it """
+        self._data = data
+        self.volumes = []
+        for start, sh in zip(self._offsets, self._shapes):
+            size = int(np.prod(sh))
+            self.volumes.append(data[start:start + size].reshape(tuple(sh)))
+        # one np.void record per voxel (all channels):
+        self._voxels = data.view(
+            np.dtype((np.void, data.itemsize * int(self._shapes[0, 3]))))
+        self._templates = dict()
+        self._local = threading.local()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in ('volumes', '_voxels', '_templates', '_local'):
+            del state[key]
+        if self._filename is not None:
+            # shared stores only carry the name of their file
+            del state['_data']
+        return state
+
+    def __setstate__(self, state):
+        data = state.pop('_data', None)
+        self.__dict__.update(state)
+        if '_pads' not in state:
+            # stores pickled before virtual padding hold padded volumes
+            self._pads = np.zeros((len(self._shapes), 3), dtype=np.intp)
+            self._dims = self._shapes[:, :3].copy()
+            self._zero_index = None
+        if '_scales' not in state:
+            self._scales = None
+        if self._filename is not None:
+            data = np.load(self._filename, mmap_mode='r')
+        self._bind(data)
+
+    def share(self, filename):
+        """
+        Moves the packed volumes into a memory mapped .npy file, so that
+        other processes can map the same pages instead of holding a copy.
+        Pickled shared stores only carry the file name and reopen it.
+
+        Args:
+            filename (str): file to write, e.g. on a tmpfs such as /dev/shm
+        """
+        with open(filename, 'wb') as f:
+            np.save(f, self._data)
+        self._filename = filename
+        self._bind(np.load(filename, mmap_mode='r'))
+
+    @property
+    def channels(self):
+        return int(self._shapes[0, 3])
+    @property
+    def dtype(self):
+        return self._data.dtype
+    @property
+    def shared(self):
+        return self._filename is not None
+    @property
+    def scales(self):
+        """ Per channel scales of integer stores (value = stored * scale), or None """
+        return self._scales
+    @property
+    def layout(self):
+        """ (pads, dims) of the virtual zero padding, see __init__ """
+        return self._pads.copy(), self._dims.copy()
+
+    def stored_indices(self, sub_idx, ijk):
+        """ Indices into volumes[sub_idx] of the (padded) voxel indices ijk """
+        return np.asarray(ijk, dtype=np.intp) - self._pads[sub_idx]
+
+    def patch_shape(self, radius, scale=1, shuffle=1):
+        side = scale * (2 * radius + 1) // shuffle
+        return (side, side, side, self.channels * shuffle**3)
+
+    def gather(self, pindlist, radius, scale=1, out=None, shuffle=1):
+        """
+        Gathers the cubic patches centred at the rows of pindlist.
+        Along each axis the patch around centre c spans
+        scale*(c - radius) to scale*(c + radius + 1).
+
+        Args:
+            pindlist (np.ndarray): rows of form [subject_idx, i, j, k]
+            radius (int): patch radius
+            scale (int): 1 for low-res volumes, us_rate for hi-res ones
+            out (np.ndarray): optional C-contiguous batch buffer of shape
+                              (N,) + patch_shape(radius, scale, shuffle)
+            shuffle (int): rate of the reverse periodic shuffle applied to
+                           the gathered patches, 1 for none
+
+        Returns:
+            out (np.ndarray): the patches, shape (N, side, side, side, channels)
+                              (float32 by default for integer stores)
+        """
+        n = pindlist.shape[0]
+        shape = (n,) + self.patch_shape(radius, scale, shuffle)
+        if out is None:
+            out = np.empty(shape, dtype=self._data.dtype
+                           if self._scales is None else 'float32')
+        elif out.shape != shape or not out.flags.c_contiguous:
+            raise ValueError('Batch buffer must be C-contiguous with shape %s'
+                             % (shape,))
+        if n == 0:
+            return out
+        if shuffle > 1:
+            # gather the hi-res patches into scratch, then shuffle them in
+            hr_shape = (n,) + self.patch_shape(radius, scale)
+            if hr_shape[1] % shuffle:
+                raise ValueError('Patch size is not divisible by the shuffling rate.')
+            hr = self._scratch_buffer(hr_shape, out.dtype)
+            self.gather(pindlist, radius, scale=scale, out=hr)
+            return du.backward_shuffle_batch(hr, shuffle, out=out)
+
+        side = shape[1]
+        subj = pindlist[:, 0]
+        start = scale * (np.asarray(pindlist[:, 1:4], dtype=np.intp) - radius)
+        if np.any(start < 0) or np.any(start + side > self._dims[subj]):
+            raise ValueError('Some patches extend beyond the volume bounds.')
+        start -= self._pads[subj]
+        dims = self._shapes[subj, :3]
+        # patches reaching into the virtual padding:
+        outside = np.any((start < 0) | (start + side > dims), axis=1)
+        any_outside = np.any(outside)
+
+        # voxel offset of the first voxel of each patch:
+        base = self._voxel_offsets[subj] + (
+            (start[:, 0] * dims[:, 1] + start[:, 1]) * dims[:, 2] + start[:, 2])
+
+        out2d = out.reshape(n, side ** 3, self.channels)
+        ids = self._shape_ids[subj]
+        uniq_ids = np.unique(ids)
+        single = len(uniq_ids) == 1
+        for sid in uniq_ids:
+            tmpl = self._template(sid, side)
+            rows = slice(None) if single else np.flatnonzero(ids == sid)
+            nrows = n if single else len(rows)
+            idx = self._index_buffer(nrows * tmpl.size).reshape(nrows, tmpl.size)
+            np.add(base[rows, np.newaxis], tmpl, out=idx)
+            pos = np.flatnonzero(outside[rows]) if any_outside else ()
+            if len(pos) > 0:
+                sel = pos if single else rows[pos]
+                idx[pos] = self._padded_index(subj[sel], start[sel], side)
+            # bounds are checked above, so 'clip' only avoids a buffered copy
+            if single and out.dtype == self._data.dtype:
+                np.take(self._voxels, idx, out=out2d.view(self._voxels.dtype)[..., 0],
+                        mode='clip')
+            else:
+                vox = np.take(self._voxels, idx, mode='clip')
+                out2d[rows] = vox.view(self._data.dtype).reshape(
+                    nrows, side ** 3, self.channels)
+        if self._scales is not None:
+            out2d *= self._scales
+        return out
+
+    def _padded_index(self, subj, start, side):
+        """
+        Voxel indices of patches reaching into the virtual padding, where the
+        padded voxels point to the zero voxel. start is in stored coordinates.
+        """
+        if self._zero_index is None:
+            raise ValueError('Some patches extend beyond the volume bounds.')
+        dims = self._shapes[subj, :3, np.newaxis]
+        coords = start[:, :, np.newaxis] + np.arange(side, dtype=np.intp)
+        valid = (coords >= 0) & (coords < dims)
+        coords = np.clip(coords, 0, dims - 1)
+        i = coords[:, 0, :, np.newaxis, np.newaxis]
+        j = coords[:, 1, np.newaxis, :, np.newaxis]
+        k = coords[:, 2, np.newaxis, np.newaxis, :]
+        idx = self._voxel_offsets[subj, np.newaxis, np.newaxis, np.newaxis] + (
+            (i * dims[:, 1, :, np.newaxis, np.newaxis] + j)
+            * dims[:, 2, :, np.newaxis, np.newaxis] + k)
+        inside = (valid[:, 0, :, np.newaxis, np.newaxis]
+                  & valid[:, 1, np.newaxis, :, np.newaxis]
+                  & valid[:, 2, np.newaxis, np.newaxis, :])
+        idx[~inside] = self._zero_index
+        return idx.reshape(len(subj), side ** 3)
+
+    def _template(self, sid, side):
+        """ Voxel offsets of a patch's voxels relative to its first voxel """
+        key = (sid, side)
+        if key not in self._templates:
+            _, dimy, dimz, _ = self._uniq_shapes[sid]
+            r = np.arange(side, dtype=np.intp)
+            i, j, k = np.ix_(r, r, r)
+            self._templates[key] = ((i * dimy + j) * dimz + k).ravel()
+        return self._templates[key]
+
+    def _index_buffer(self, size):
+        # one reusable buffer per thread, so concurrent gathers do not race
+        buf = getattr(self._local, 'idx', None)
+        if buf is None or buf.size < size:
+            buf = np.empty(size, dtype=np.intp)
+            self._local.idx = buf
+        return buf[:size]
+
+    def _scratch_buffer(self, shape, dtype):
+        # per-thread buffer of unshuffled hi-res patches
+        size = int(np.prod(shape))
+        buf = getattr(self._local, 'hr', None)
+        if buf is None or buf.size < size or buf.dtype != dtype:
+            buf = np.empty(size, dtype=dtype)
+            self._local.hr = buf
+        return buf[:size].reshape(shape)
+
+
 class Data(object):
     """
     Generic class for data patch generation.
@@ -29,11 +332,57 @@ class Data(object):
     This class assumes that the low-res image is in the hi-res space
     with repeated or interpolated voxels.
     """
+    # attributes rebuilt on demand and never pickled:
+    _transient = ('_inp_store', '_out_store', '_buffers', '_rngs',
+                  '_train_patches', '_val_patches')
+    # version of the patch library folders written by save_patchlib:
+    _patchlib_version = 1
+    # attributes _extract_batch needs in an extraction process:
+    _extraction_keys = ('_inpN', '_outM', '_us_rate', '_shuffle', '_transform',
+                        '_augment_mode')
+    # no data augmentation unless set_augmentation is called:
+    _augment_mode = None
+    # virtual padding of the volumes (see VolumeStore), none by default:
+    _layouts = (None, None)
+    # training patches drawn per minibatch instead of from the library:
+    _streaming = False
+    # seed of the streamed training sample the whitening statistics are
+    # computed from, so that every load of a library gets the same ones:
+    _stats_seed = 0
+    _method = 'default'
+    _bgval = 0
+    # storage type of the volumes (see VolumeStore):
+    _storage = 'float32'
+    # this consumer's slice of each training epoch (see set_shard):
+    _shard = 0
+    _num_shards = 1
+
     def __init__(self):
         self._epochs_completed = 0
         self._index_in_epoch = 0
         self._index = 0
         self._transform = dict()
+        self._reset_transient()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in self._transient:
+            state.pop(key, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._reset_transient()
+        if '_train_order' not in state and '_train_pindlistI' in state:
+            self._reset_order()
+
+    def _reset_transient(self):
+        self._inp_store = None
+        self._out_store = None
+        self._buffers = dict()
+        self._train_patches = None
+        self._val_patches = None
+        self.set_seed(getattr(self, '_seed', None))
 
     @property
     def scale_params(self):
@@ -42,6 +391,9 @@ class Data(object):
     def size(self):  # get the size of training set
         return self._size
     @property
+    def shard_size(self):  # number of training patches per epoch of this shard
+        return self._size // self._num_shards
+    @property
     def size_valid(self): # get the size of validation set
         return self._valsize
     @property
@@ -71,7 +423,14 @@ class Data(object):
                          method='default',
                          pad_size=-1,
                          clip=True,
-                         shuffle=True):
+                         shuffle=True,
+                         volume_cache=None,
+                         stats_samples=10000,
+                         sample_weights=None,
+                         streaming=False,
+                         storage='float32',
+                         subject_info=None,
+                         index_cache=None):
 
         """
         Generates the patchlib, which is equivalent to creating the randomised
@@ -83,13 +442,35 @@ class Data(object):
             inpN (int): input patch size = (2*inpN + 1)
             outM (int): output patch size = (2*outM + 1)
             inp_images (list): Images that form the sources
-            out_images (list): Images that form the output
+            out_images (list): Images that form the output. Both lists are
+                               consumed by the preprocessing (see _preprocess).
             us_rate (int): Downsampling rate
             whiten (whiten type): Whiten data or not
             bgval (float): Background value: voxels outside the mask
-            method (str): how to
+            method (str): how to sample the patch centres: 'default'
+                          (uniformly), 'edge', 'anisotropy' or 'weighted'
+                          (see _sampling_weights)
             sample_size (int): Used internally to sample the voxles randomly
                                  within the list of subjects
+            volume_cache (str): optional folder of memory mapped preprocessed
+                                volumes. Loaded if it exists (the images may
+                                then be None), otherwise written.
+            stats_samples (int): number of training patches the 'standard'
+                                 whitening statistics are computed from
+                                 (all of them if <= 0)
+            sample_weights (list): weight volumes for method='weighted'
+            streaming (bool): only fix the validation patches. The training
+                              patch centres are then drawn afresh for each
+                              minibatch from the valid centres, and an epoch
+                              is a nominal (1-eval_frac)*size patches.
+            storage (str): type the volumes are held in: 'float32',
+                           'float16' or 'int16' (scaled per channel). Patches
+                           are upcast to float32 as they are gathered.
+            subject_info (list): optional precomputed facts about each
+                                 subject (see common.subject_manifest),
+                                 which spare the preprocessing some scans
+            index_cache (str): optional folder of the foreground voxels of
+                               the subjects (see _get_valid_indices)
 
         Returns:
             self: The class instance itself
@@ -109,25 +490,35 @@ class Data(object):
         self._shuffle          = shuffle
         self._pad_size         = pad_size
         self._whiten           = whiten
+        self._method           = method
+        self._bgval            = bgval
+        self._streaming        = streaming
+        self._storage          = storage
 
         # ------------------ Preprocess --------------------------------
         # store input and output for patch collection
-        inp_images, out_images = self._preprocess(inp_images, out_images,
-                                                  inpN,
-                                                  us_rate,
-                                                  pad_size=pad_size,
-                                                  clip=clip,
-                                                  shuffle=shuffle)
-        self._inp_images = inp_images
-        self._out_images = out_images
+        self._prepare_volumes(inp_images, out_images, inpN, us_rate,
+                              pad_size=pad_size, clip=clip, shuffle=shuffle,
+                              volume_cache=volume_cache,
+                              subject_info=subject_info)
 
         # --------------- Prepare a patch library ----------------------
         print('Checking valid voxels...')
         print('Sampling method: ' + method)
-        vox_indx = self._get_valid_indices(inp_images, inpN, bgval)
+        vox_indx = self._get_valid_indices(self._inp_images, inpN, bgval,
+                                           index_cache=index_cache,
+                                           layout=self._layouts[0])
 
         # randomly sample patch indices
-        pindlistI = self._select_patch_indices(size, vox_indx)
+        weights = self._sampling_weights(method, vox_indx, sample_weights)
+        if streaming:
+            # only the validation patches are selected, see _next_stream_indices
+            pindlistI = self._select_patch_indices(self._valsize, vox_indx,
+                                                   weights)
+            self._init_stream(vox_indx, weights, exclude=pindlistI)
+            self._stats_seed = np.random.randint(2**31 - 1)
+        else:
+            pindlistI = self._select_patch_indices(size, vox_indx, weights)
 
         # Split into validation and training sets:
         self._val_pindlistI = pindlistI[:self._valsize, ...]
@@ -135,11 +526,12 @@ class Data(object):
 
         self._val_pindlistO = self._val_pindlistI
         self._train_pindlistO = self._train_pindlistI
-
+        self._reset_order()
 
         # Compute normalisation transform:
         # todo: need to include normalisation in the preprocessing function.
-        self._transform=self._compute_normalisation_transform(whiten, inp_images, out_images, True, us_rate)
+        self._transform=self._compute_normalisation_transform(whiten, inp_images, out_images, True, us_rate,
+                                                              stats_samples=stats_samples)
 
         print('Patch-lib size:', size,
               'Train size:', self._size,
@@ -154,7 +546,7 @@ class Data(object):
             filename (str): Filename
         """
         with open(filename, 'wb') as handle:
-            pickle.dump(self, handle)
+            pickle.dump(self, handle, pickle.HIGHEST_PROTOCOL)
 
     def load(self, filename):
         """
@@ -169,6 +561,7 @@ class Data(object):
         """
         with open(filename, 'rb') as handle:
             self.__dict__.update(pickle.load(handle).__dict__)
+        self._reset_transient()
         self._epochs_completed = 0
         self._index = 0
         self._index_in_epoch   = 0
@@ -179,6 +572,111 @@ class Data(object):
         return self
 
 
+    def save_patchlib(self, dirname):
+        """
+        Saves the patch library (without the data) as a compact folder:
+            header.json: format version and parameters,
+            train_indices.npy, valid_indices.npy: int32 rows of form
+                [subject_idx, i, j, k], in the current order (no training
+                rows in streaming mode),
+            transform_*.npy: float32 normalisation arrays.
+        Input and output patches share the same centres.
+        The folder is written next to dirname and then moved in place.
+
+        Args:
+            dirname (str): folder name
+        """
+        tmpname = dirname + '.%d.tmp' % os.getpid()
+        os.makedirs(tmpname)
+        for name, indices in (('train', self._train_indices(slice(None))[0]),
+                              ('valid', self._val_indices(slice(None))[0])):
+            np.save(os.path.join(tmpname, name + '_indices.npy'),
+                    indices.astype(np.int32))
+        transform = dict()
+        for key, val in self._transform.items():
+            if np.ndim(val) == 0:
+                transform[key] = float(val)
+            else:
+                transform[key] = 'transform_' + key + '.npy'
+                np.save(os.path.join(tmpname, transform[key]),
+                        np.asarray(val, dtype=np.float32))
+        header = {'format': 'patchlib',
+                  'version': self._patchlib_version,
+                  'params': {'size': int(self._size),
+                             'valsize': int(self._valsize),
+                             'inpN': int(self._inpN),
+                             'outM': int(self._outM),
+                             'us_rate': int(self._us_rate),
+                             'shuffle': bool(self._shuffle),
+                             'pad_size': int(self._pad_size),
+                             'whiten': self._whiten,
+                             'method': self._method,
+                             'bgval': float(self._bgval),
+                             'streaming': bool(self._streaming),
+                             'stats_seed': int(self._stats_seed)},
+                  'transform': transform}
+        with open(os.path.join(tmpname, 'header.json'), 'w') as handle:
+            json.dump(header, handle, indent=2, sort_keys=True)
+        if os.path.exists(dirname):
+            shutil.rmtree(dirname)
+        os.rename(tmpname, dirname)
+
+    def load_patchlib(self, dirname):
+        """
+        Opens a patch library saved with save_patchlib. The index arrays are
+        memory mapped, so this is fast even for millions of patches.
+        Also resets epoch count and minibatch indexing
+
+        Args:
+            dirname (str): folder name
+
+        Returns:
+            self: The class instance itself
+        """
+        with open(os.path.join(dirname, 'header.json'), 'r') as handle:
+            header = json.load(handle)
+        if header.get('format') != 'patchlib' or \
+                header.get('version', 0) > self._patchlib_version:
+            raise ValueError('Unsupported patch library: %s (format %s, version %s)'
+                             % (dirname, header.get('format'), header.get('version')))
+        params = header['params']
+        self._size = params['size']
+        self._valsize = params['valsize']
+        self._inpN = params['inpN']
+        self._outM = params['outM']
+        self._us_rate = params['us_rate']
+        self._shuffle = params['shuffle']
+        self._pad_size = params['pad_size']
+        self._whiten = params['whiten']
+        self._method = params.get('method', 'default')
+        self._bgval = params.get('bgval', 0)
+        self._streaming = params.get('streaming', False)
+        self._stats_seed = params.get('stats_seed', 0)
+        self._sparams = ScaleParams()
+
+        self._train_pindlistI = np.load(os.path.join(dirname, 'train_indices.npy'),
+                                        mmap_mode='r')
+        self._val_pindlistI = np.load(os.path.join(dirname, 'valid_indices.npy'),
+                                      mmap_mode='r')
+        self._train_pindlistO = self._train_pindlistI
+        self._val_pindlistO = self._val_pindlistI
+        self._transform = dict()
+        for key, val in header['transform'].items():
+            if isinstance(val, float):
+                self._transform[key] = val
+            else:
+                self._transform[key] = np.load(os.path.join(dirname, val))
+
+        self._reset_order()
+        self._epochs_completed = 0
+        self._index = 0
+        self._index_in_epoch   = 0
+        self._valid_index      = 0
+        print ('Patch-lib size:', self._size + self._valsize,
+               'Train size:', self._size,
+               'Valid size:', self._valsize)
+        return self
+
     def load_scale_params(self, filename):
         sparams = ScaleParams()
         with open(filename, 'rb') as handle:
@@ -205,24 +703,63 @@ class Data(object):
 
     def load_patch_indices(self, filename, transname,
                            inp_images, out_images, inpN, us_rate, whiten,
-                           pad_size=-1, clip=False, shuffle=True):
-
-        # Load the indices:
-        self.load(filename)
+                           pad_size=-1, clip=False, shuffle=True,
+                           volume_cache=None, stats_samples=10000,
+                           storage='float32', subject_info=None,
+                           index_cache=None):
+
+        # Load the indices (patch library folder or pickled Data):
+        if os.path.isdir(filename):
+            self.load_patchlib(filename)
+        else:
+            self.load(filename)
+        self._storage = storage
 
         # Preprocess:
-        inp_images, out_images = self._preprocess(inp_images, out_images,
-                                                  inpN,
-                                                  us_rate,
-                                                  pad_size=pad_size,
-                                                  clip=clip,
-                                                  shuffle=shuffle)
+        self._prepare_volumes(inp_images, out_images, inpN, us_rate,
+                              pad_size=pad_size, clip=clip, shuffle=shuffle,
+                              volume_cache=volume_cache,
+                              subject_info=subject_info)
+        if self._streaming:
+            vox_indx = self._get_valid_indices(self._inp_images, inpN,
+                                               self._bgval,
+                                               index_cache=index_cache,
+                                               layout=self._layouts[0])
+            weights = self._sampling_weights(self._method, vox_indx)
+            self._init_stream(vox_indx, weights, exclude=self._val_pindlistI)
 
         # Normalise:
-        self._inp_images = inp_images
-        self._out_images = out_images
-        self._transform = self._compute_normalisation_transform(whiten, inp_images, out_images, True, us_rate)
+        self._transform = self._compute_normalisation_transform(whiten, inp_images, out_images, True, us_rate,
+                                                                stats_samples=stats_samples)
+
+        return self
 
+    def save_volumes(self, dirname):
+        """
+        Saves the preprocessed volumes as memory mapped .npy files in dirname,
+        together with their layout (volumes.pkl). The dataset then reads its
+        volumes from these files.
+        """
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        self.share_volumes(dirname)
+        # write the layout last, so its presence marks a complete folder:
+        layout = os.path.join(dirname, 'volumes.pkl')
+        tmpname = layout + '.%d' % os.getpid()
+        with open(tmpname, 'wb') as handle:
+            pickle.dump((self._inp_store, self._out_store), handle, -1)
+        os.rename(tmpname, layout)
+
+    def load_volumes(self, dirname):
+        """
+        Maps the preprocessed volumes saved with save_volumes.
+
+        Returns:
+            self: The class instance itself
+        """
+        with open(os.path.join(dirname, 'volumes.pkl'), 'rb') as handle:
+            inp_store, out_store = pickle.load(handle)
+        self._set_stores(inp_store, out_store)
         return self
 
     def visualise_patches(self, pindlist, iz2=-1, ic=0, figsize=(6,6)):
@@ -237,8 +774,7 @@ class Data(object):
         df = self._inpN - self._outM
         if iz2 < 0:
             iz2 = self._outM if self._shuffle else self._outM*self._us_rate
-        voxindlist1 = self._train_pindlistI[pindlist,:]
-        voxindlist2 = self._train_pindlistO[pindlist,:]
+        voxindlist1, voxindlist2 = self._train_indices(pindlist)
         inp_patches, out_patches = (
                 self._collect_patches(self._inpN, self._outM,
                                       self._inp_images, self._out_images,
@@ -281,7 +817,88 @@ class Data(object):
         return inp_patches, out_patches
 
 
-    def next_batch(self, batch_size):
+    def set_seed(self, seed=None):
+        """
+        Seeds the reshuffling of the training and validation patch lists,
+        and the data augmentation.
+        Each minibatch stream gets its own random generator, so the order
+        of the minibatches does not depend on how the two are interleaved.
+        With seed=None the global numpy random state is used.
+        """
+        self._seed = seed
+        if seed is None:
+            self._rngs = {'train': np.random, 'valid': np.random,
+                          'augment': np.random}
+        else:
+            self._rngs = {'train': np.random.RandomState([seed, 0]),
+                          'valid': np.random.RandomState([seed, 1]),
+                          'augment': np.random.RandomState(
+                              [seed, 2] + self._shard_key())}
+        # (epoch, generator) of the streamed training centres, and
+        # (epoch, rows) of this shard:
+        self._rngs['stream'] = None
+        self._rngs['shard'] = None
+
+    def set_shard(self, shard, num_shards):
+        """
+        Makes this instance one of num_shards consumers of the training set,
+        e.g. the trainer processes of data-parallel or multi-node training.
+        Each epoch is a permutation of the whole training set seeded by
+        (seed, epoch) only, and shard k takes every num_shards-th row of it
+        from row k. The shards of an epoch are therefore disjoint and the
+        same in every process and run, without any coordination. All shards
+        have shard_size = size // num_shards patches per epoch, and must
+        share the seed (see set_seed). The validation set is not split.
+        Augmentation codes and streamed centres (streaming mode) are drawn
+        independently for each shard.
+
+        Args:
+            shard (int): index of this shard, in [0, num_shards)
+            num_shards (int): number of shards
+        """
+        if not 0 <= shard < num_shards:
+            raise ValueError('Shard %d out of range for %d shards.'
+                             % (shard, num_shards))
+        if num_shards > 1 and self._seed is None:
+            raise ValueError('Sharded sampling needs a seed shared by all shards.')
+        self._shard = shard
+        self._num_shards = num_shards
+        self._epochs_completed = 0
+        self._index = 0
+        self._index_in_epoch = 0
+        self.set_seed(self._seed)
+
+    def _shard_key(self):
+        """ Extra seed words that tell the shards apart """
+        return [self._shard] if self._num_shards > 1 else []
+
+    def set_augmentation(self, mode=None):
+        """
+        Augments the training minibatches with random symmetries of the
+        voxel grid, drawn independently for each patch pair. The diffusion
+        tensors of the input and output patches are transformed consistently
+        (D -> R D R^T), assuming they are given in the frame of the voxel
+        axes, in the channel order [Dxx, Dxy, Dxz, Dyy, Dyz, Dzz].
+        Validation minibatches are not augmented.
+
+        Args:
+            mode (str): 'flip': axis flips (8 symmetries),
+                        'rotate': 90 degree rotations (24),
+                        'all': flips, axis permutations and rotations (48),
+                        None or 'none': no augmentation
+        """
+        if mode in (None, 'none'):
+            self._augment_mode = None
+            return
+        if mode not in _SYMMETRY_GROUPS:
+            raise ValueError('Unknown augmentation mode: ' + str(mode))
+        inp_store, out_store = self._get_stores(self._inp_images,
+                                                self._out_images)
+        if inp_store.channels != 6 or out_store.channels != 6:
+            raise ValueError('Augmentation needs 6-channel DTI patches.')
+        self._augment_mode = mode
+
+    def next_batch(self, batch_size, bufs=None):
         """
         Returns the next training minibatch with size: batch_size of example data
         Alert: while iterating over the entire sample-set, this method
@@ -293,191 +910,537 @@ class Data(object):
         Args:
             batch_size (int): minibatch size, should be smaller than
                               patch library dataset size
+            bufs (tuple): optional (input, output) float32 buffers to fill
+
+        Returns:
+            minibatch (tuple): containing input/output example batches
+                               (float32 np.ndarray compatible with tf).
+                               The arrays are reused buffers that the next
+                               call overwrites; copy them to keep them.
+        """
+        if bufs is None:
+            bufs = self._batch_buffers('train', batch_size)
+        if self._train_patches is not None:
+            # materialised: gather the rows of the whitened patches
+            rows = self._next_train_rows(batch_size)
+            np.take(self._train_patches[0], rows, axis=0, out=bufs[0])
+            np.take(self._train_patches[1], rows, axis=0, out=bufs[1])
+            return bufs
+        job = self._draw_train_job(batch_size)
+        return self._extract_batch(job, bufs)
+
+
+    def next_val_batch(self, batch_size, bufs=None):
+        """
+        Returns the next validation minibatch with size: batch_size of example data
+        This method does not change the epoch count.
+        If the validation set is materialised (see materialise_valid), the
+        minibatch is a slice of it and bufs is ignored.
+
+        Args:
+            batch_size (int): minibatch size, should be smaller than
+                              patch library dataset size
+            bufs (tuple): optional (input, output) float32 buffers to fill
 
         Returns:
             minibatch (tuple): containing input/output example batches
-                               (np.ndarray compatible with tf)
+                               (float32 np.ndarray compatible with tf),
+                               overwritten by the next call.
+        """
+        if self._val_patches is not None:
+            batch = self._next_val_slice(batch_size)
+            return self._val_patches[0][batch], self._val_patches[1][batch]
+        job = self._draw_val_job(batch_size)
+        if bufs is None:
+            bufs = self._batch_buffers('valid', batch_size)
+        return self._extract_batch(job, bufs)
+
+
+    def materialise(self, max_memory=2**30, valid=False, chunk_size=100):
+        """
+        Extracts and whitens all the training patch pairs once, if they fit
+        in max_memory bytes, so that next_batch gathers the rows of one
+        contiguous array instead of re-extracting the patches every epoch.
+        Otherwise the patches keep being extracted on demand. Streamed or
+        augmented training patches differ in every epoch, so these are never
+        materialised. The normalisation transform must be computed beforehand.
+
+        Args:
+            max_memory (int): memory budget in bytes
+            valid (bool): materialise the validation set as well (see
+                          materialise_valid) within what the training
+                          set leaves of the budget, or within all of it
+                          if the training set is not materialised
+            chunk_size (int): number of patches extracted at a time
+
+        Returns:
+            materialised (bool): whether the training patches were materialised
+        """
+        if self._streaming or self._augment_mode is not None:
+            print('Streamed or augmented training patches are extracted on demand')
+            if valid:
+                self.materialise_valid(max_memory=max_memory,
+                                       chunk_size=chunk_size)
+            return False
+        nbytes = self._patch_bytes(self._size)
+        if nbytes > max_memory:
+            print('The training set (%.1f MB) is over the memory budget, '
+                  'extracting its patches on demand' % (nbytes / 2.**20))
+            if valid:
+                self.materialise_valid(max_memory=max_memory,
+                                       chunk_size=chunk_size)
+            return False
+        print('Materialising the training set in memory (%.1f MB)'
+              % (nbytes / 2.**20))
+        inp, out = [np.empty((self._size,) + buf.shape[1:], dtype='float32')
+                    for buf in self._new_batch_buffers(1)]
+        self._extract_rows(lambda rows: (self._train_pindlistI[rows, :],
+                                         self._train_pindlistO[rows, :]),
+                           self._size, inp, out, chunk_size)
+        self._train_patches = (inp, out)
+        if valid:
+            # a set over what is left of the budget goes to a mapped file:
+            self.materialise_valid(max_memory=max_memory - nbytes,
+                                   chunk_size=chunk_size)
+        return True
+
+    def _patch_bytes(self, n):
+        """ Size in bytes of n float32 input/output patch pairs """
+        return n * 4 * sum(int(np.prod(buf.shape[1:]))
+                           for buf in self._new_batch_buffers(1))
+
+    def _extract_rows(self, indices, n, inp, out, chunk_size=100):
+        """ Extracts patch pairs 0..n-1 (indices(rows) gives their patch indices) into inp/out """
+        for start in range(0, n, chunk_size):
+            end = min(start + chunk_size, n)
+            pindlist1, pindlist2 = indices(slice(start, end))
+            self._extract_batch((pindlist1, pindlist2, None),
+                                (inp[start:end], out[start:end]))
+
+    def materialise_valid(self, max_memory=2**30, tmp_dir=None,
+                          chunk_size=100):
         """
+        Extracts and whitens the whole validation set once, so that
+        next_val_batch returns slices of it instead of re-extracting patches.
+        The set is then gone through in a fixed order. The normalisation
+        transform must be computed beforehand.
+
+        Args:
+            max_memory (int): size in bytes up to which the patches are held
+                              in memory, larger sets go to a memory mapped file
+            tmp_dir (str): folder of the memory mapped file (system default
+                           if None). The file is deleted once it is mapped.
+            chunk_size (int): number of patches extracted at a time
+        """
+        inp_shape, out_shape = [(self._valsize,) + buf.shape[1:]
+                                for buf in self._new_batch_buffers(1)]
+        nbytes = self._patch_bytes(self._valsize)
+        if nbytes <= max_memory:
+            print('Materialising the validation set in memory (%.1f MB)'
+                  % (nbytes / 2.**20))
+            inp = np.empty(inp_shape, dtype='float32')
+            out = np.empty(out_shape, dtype='float32')
+        else:
+            print('Materialising the validation set in a memory mapped file '
+                  '(%.1f MB)' % (nbytes / 2.**20))
+            inp = _scratch_memmap(inp_shape, tmp_dir)
+            out = _scratch_memmap(out_shape, tmp_dir)
+
+        self._extract_rows(self._val_indices, self._valsize, inp, out,
+                           chunk_size)
+        self._val_patches = (inp, out)
+        self._valid_index = 0
+
+    def _next_train_indices(self, batch_size):
+        """ Advances the training stream by one minibatch.
+        Returns:
+            pindlist1, pindlist2: input and output patch indices
+        """
+        if self._streaming:
+            return self._next_stream_indices(batch_size)
+        rows = self._next_train_rows(batch_size)
+        return self._train_pindlistI[rows, :], self._train_pindlistO[rows, :]
+
+    def _next_train_rows(self, batch_size):
+        """ Advances the training stream by one minibatch.
+        Returns:
+            rows (np.ndarray): rows of the training patch library
+        """
+        if self._num_shards > 1:
+            return self._next_shard_rows(batch_size)
         assert batch_size <= self._size
         start = self._index_in_epoch
         self._index_in_epoch += batch_size
         if self._index_in_epoch > self._size:
             # Finished epoch
             self._epochs_completed += 1
-            # Shuffle the data
+            # Shuffle the data (only the order of the rows)
             perm = np.arange(self._size)
-            np.random.shuffle(perm)
-            self._train_pindlistI = self._train_pindlistI[perm,:]
-            self._train_pindlistO = self._train_pindlistO[perm,:]
+            self._rngs['train'].shuffle(perm)
+            self._train_order = self._train_order[perm]
             # Start next epoch
             start = 0
             self._index = 0
             self._index_in_epoch = batch_size
 
         end = self._index_in_epoch
-        pindlist1 = self._train_pindlistI[start:end,:]
-        pindlist2 = self._train_pindlistO[start:end,:]
-        inp, out = self._collect_patches(self._inpN, self._outM,
-                                         self._inp_images, self._out_images,
-                                         pindlist1, pindlist2,
-                                         us_rate=self._us_rate,
-                                         shuffle=self._shuffle)
         self._index += 1
-        inp, out = self._normalise(inp, out)
-        return inp, out
+        return self._train_order[start:end]
 
-
-    def next_val_batch(self, batch_size):
+    def _next_shard_rows(self, batch_size):
+        """ Advances the training stream of this shard by one minibatch """
+        assert batch_size <= self.shard_size
+        start = self._index_in_epoch
+        self._index_in_epoch += batch_size
+        if self._index_in_epoch > self.shard_size:
+            # Finished epoch
+            self._epochs_completed += 1
+            start = 0
+            self._index = 0
+            self._index_in_epoch = batch_size
+        self._index += 1
+        shard = self._rngs['shard']
+        if shard is None or shard[0] != self._epochs_completed:
+            perm = np.random.RandomState(
+                [self._seed, 4, self._epochs_completed]).permutation(self._size)
+            shard = (self._epochs_completed,
+                     perm[self._shard::self._num_shards][:self.shard_size])
+            self._rngs['shard'] = shard
+        return self._train_order[shard[1][start:self._index_in_epoch]]
+
+    def _next_stream_indices(self, batch_size):
+        """ Draws the patch centres of the next training minibatch in streaming mode """
+        self._index_in_epoch += batch_size
+        if self._index_in_epoch > self.shard_size:
+            # Finished (nominal) epoch
+            self._epochs_completed += 1
+            self._index = 0
+            self._index_in_epoch = batch_size
+        self._index += 1
+        stream = self._rngs['stream']
+        if stream is None or stream[0] != self._epochs_completed:
+            stream = (self._epochs_completed,
+                      self._stream_rng(self._epochs_completed))
+            self._rngs['stream'] = stream
+        pindlist = self._draw_stream_centres(stream[1], batch_size)
+        return pindlist, pindlist
+
+    def _stream_rng(self, epoch):
+        """ Random generator of the streamed training centres of an epoch """
+        if self._seed is None:
+            return np.random
+        return np.random.RandomState([self._seed, 3, epoch] + self._shard_key())
+
+    def _init_stream(self, vox_indx, weights=None, exclude=None):
         """
-        Returns the next validation minibatch with size: batch_size of example data
-        This method does not change the epoch count.
+        Sets up the on-the-fly sampling of the training patch centres.
 
         Args:
-            batch_size (int): minibatch size, should be smaller than
-                              patch library dataset size
+            vox_indx (list): valid centres of each subject
+            weights (list): their sampling weights, or None (uniform)
+            exclude (np.ndarray): rows [subject_idx, i, j, k] of centres that
+                                  are never drawn, i.e. the validation set
+        """
+        self._stream_vox = []
+        self._stream_cdf = None if weights is None else []
+        for idx, ijk in enumerate(vox_indx):
+            keep = np.ones(ijk.shape[0], dtype=bool)
+            if exclude is not None:
+                rows = np.asarray(exclude[exclude[:, 0] == idx, 1:])
+                if rows.shape[0] > 0:
+                    dims = tuple(np.maximum(ijk.max(axis=0),
+                                            rows.max(axis=0)) + 1)
+                    keep = ~np.in1d(np.ravel_multi_index(ijk.T, dims),
+                                    np.ravel_multi_index(rows.T, dims))
+            if not np.any(keep):
+                raise ValueError('Subject %d has no valid training patches left.'
+                                 % idx)
+            self._stream_vox.append(np.ascontiguousarray(ijk[keep],
+                                                         dtype=np.int32))
+            if weights is not None:
+                self._stream_cdf.append(np.cumsum(weights[idx][keep]))
+
+    def _draw_stream_centres(self, rng, n):
+        """
+        Draws n training patch centres with replacement: the subjects
+        uniformly, then the centres within them uniformly or by weight.
 
         Returns:
-            minibatch (tuple): containing input/output example batches
-                               (np.ndarray compatible with tf)
+            pindlist (np.ndarray): rows of form [subject_idx, i, j, k]
+        """
+        pindlist = np.empty((n, 4), dtype=np.int32)
+        subjects = rng.randint(len(self._stream_vox), size=n)
+        pindlist[:, 0] = subjects
+        for idx in np.unique(subjects):
+            sel = np.flatnonzero(subjects == idx)
+            if self._stream_cdf is None:
+                rows = rng.randint(self._stream_vox[idx].shape[0],
+                                   size=sel.size)
+            else:
+                cdf = self._stream_cdf[idx]
+                rows = np.searchsorted(cdf, rng.rand(sel.size) * cdf[-1],
+                                       side='right')
+            pindlist[sel, 1:] = self._stream_vox[idx][rows]
+        return pindlist
+
+    def _next_val_indices(self, batch_size):
+        """ Advances the validation stream by one minibatch.
+        Returns:
+            pindlist1, pindlist2: input and output patch indices
         """
         assert batch_size <= self._valsize
         start = self._valid_index
         self._valid_index += batch_size
         if self._valid_index > self._valsize:
-            # Shuffle the data
+            # Shuffle the data (only the order of the rows)
             perm = np.arange(self._valsize)
-            np.random.shuffle(perm)
-            self._val_pindlistI = self._val_pindlistI[perm,:]
-            self._val_pindlistO = self._val_pindlistO[perm,:]
+            self._rngs['valid'].shuffle(perm)
+            self._val_order = self._val_order[perm]
             # Start next epoch
             start = 0
             self._valid_index = batch_size
         end = self._valid_index
-        pindlist1 = self._val_pindlistI[start:end,:]
-        pindlist2 = self._val_pindlistO[start:end,:]
+        return self._val_indices(slice(start, end))
+
+    def _reset_order(self):
+        """ Sets the order of the training/validation rows to the stored one """
+        self._train_order = np.arange(self._train_pindlistI.shape[0])
+        self._val_order = np.arange(self._val_pindlistI.shape[0])
+
+    def _train_indices(self, rows):
+        """ Input/output indices of the given rows in the current order """
+        rows = self._train_order[rows]
+        return self._train_pindlistI[rows, :], self._train_pindlistO[rows, :]
+
+    def _val_indices(self, rows):
+        rows = self._val_order[rows]
+        return self._val_pindlistI[rows, :], self._val_pindlistO[rows, :]
+
+    def _next_val_slice(self, batch_size):
+        """ Advances the materialised validation stream by one minibatch """
+        assert batch_size <= self._valsize
+        start = self._valid_index
+        self._valid_index += batch_size
+        if self._valid_index > self._valsize:
+            # no reshuffling: start the next round at a random offset instead,
+            # so that the same tail patches are not always left out
+            start = self._rngs['valid'].randint(self._valsize % batch_size + 1)
+            self._valid_index = start + batch_size
+        return slice(start, self._valid_index)
+
+    def _draw_train_job(self, batch_size):
+        """
+        Draws everything random about the next training minibatch, so that
+        it can be extracted anywhere (see _extract_batch).
+        Returns:
+            job (tuple): input and output patch indices, augmentation codes
+        """
+        pindlist1, pindlist2 = self._next_train_indices(batch_size)
+        codes = None
+        if self._augment_mode is not None:
+            codes = self._rngs['augment'].randint(
+                len(_SYMMETRY_GROUPS[self._augment_mode]), size=batch_size)
+        return pindlist1, pindlist2, codes
+
+    def _draw_val_job(self, batch_size):
+        pindlist1, pindlist2 = self._next_val_indices(batch_size)
+        return pindlist1, pindlist2, None
+
+    def _extract_batch(self, job, bufs):
+        """ Gathers, augments and whitens a minibatch into the (input, output) buffers """
+        pindlist1, pindlist2, codes = job
         inp, out = self._collect_patches(self._inpN, self._outM,
                                          self._inp_images, self._out_images,
                                          pindlist1, pindlist2,
                                          us_rate=self._us_rate,
-                                         shuffle=self._shuffle
-                                         )
-        inp, out = self._normalise(inp, out)
-        return inp, out
-
-
-    def _get_valid_indices(self, img_list, psz, bgval=0):
+                                         shuffle=self._shuffle,
+                                         inp_buf=bufs[0], out_buf=bufs[1])
+        if codes is not None:
+            # before whitening, whose statistics depend on the voxel position
+            symmetries = _SYMMETRY_GROUPS[self._augment_mode]
+            _transform_dti_patches(inp, codes, symmetries)
+            _transform_dti_patches(out, codes, symmetries,
+                                   us_rate=self._us_rate if self._shuffle else 1)
+        return self._normalise(inp, out, in_place=True)
+
+    def _get_valid_indices(self, img_list, psz, bgval=0, index_cache=None,
+                           layout=None):
         """
         Finds voxels that are not in the background, then parses the list
         to ensure a patch of the required size can be extracted from that
-        voxel.
+        voxel. Only the interior of each foreground mask (at least psz
+        voxels away from the borders) is kept as centres.
 
         Args:
             img_list (list): List of images to find valid voxels
             psz (int): patch size = (2*psz + 1)
             bgval (float): Background value.
+            index_cache (str): optional folder where the foreground voxels
+                               of each subject are stored and reloaded from.
+                               They are kept in the coordinates of the
+                               unpadded images, so that runs with another
+                               patch size (hence padding) share them; the
+                               border and the padding offset are applied on
+                               loading.
+            layout (tuple): (pads, dims) of the virtual padding of the
+                            images (see VolumeStore). The indices are those
+                            of the padded images.
 
         Returns:
-            index_list (list): list of valid voxel indices
+            index_list (list): list of valid voxel indices (int32 arrays)
         """
         index_list = []
         cnt = 1
-        for img in img_list:
-            if len(img.shape)==3:
-                mask = img
-            elif len(img.shape)==4:
-                mask = img[..., 0]
-            else:
-                raise ValueError('Only 3D or 4D images handled.')
-            dims = mask.shape
-            ijk = np.array(np.where(mask != bgval), dtype=int).T
-            if ijk.size == 0:
+        for idx, img in enumerate(img_list):
+            ijk = None
+            filename = None
+            if index_cache:
+                filename = os.path.join(index_cache, 'foreground_%d_bg%g.npy'
+                                        % (idx, bgval))
+                if os.path.isfile(filename):
+                    ijk = np.load(filename)
+
+            dims = np.array(img.shape[:3])
+            pads, padded_dims = np.zeros(3, dtype=np.intp), dims
+            if layout is not None:
+                pads, padded_dims = layout[0][idx], layout[1][idx]
+            if ijk is None:
+                if len(img.shape)==3:
+                    mask = img
+                elif len(img.shape)==4:
+                    mask = img[..., 0]
+                else:
+                    raise ValueError('Only 3D or 4D images handled.')
+                ijk = np.transpose(np.nonzero(mask != bgval)).astype(np.int32)
+                if filename:
+                    if not os.path.isdir(index_cache):
+                        try:
+                            os.makedirs(index_cache)
+                        except OSError:
+                            pass  # made meanwhile by a concurrent run
+                    tmpname = filename + '.%d.npy' % os.getpid()
+                    np.save(tmpname, ijk)
+                    os.rename(tmpname, filename)
+            no_voxels = ijk.shape[0]
+            if no_voxels == 0:
                 raise ValueError('Cannot find any valid patch indices')
-            iskeep = np.zeros((ijk.shape[0], 6), dtype=bool)
-            iskeep[:, 0] = (ijk[:, 0] - psz) >= 0
-            iskeep[:, 1] = (ijk[:, 0] + psz) < dims[0]
-            iskeep[:, 2] = (ijk[:, 1] - psz) >= 0
-            iskeep[:, 3] = (ijk[:, 1] + psz) < dims[1]
-            iskeep[:, 4] = (ijk[:, 2] - psz) >= 0
-            iskeep[:, 5] = (ijk[:, 2] + psz) < dims[2]
-            iskeep = np.all(iskeep, axis=1)
-            neg_indx = np.where(iskeep == False)
-            if neg_indx[0].size > 0:
+            # interior of the padded image, in stored coordinates:
+            lo = np.maximum(psz - pads, 0)
+            hi = np.maximum(np.minimum(padded_dims - psz - pads, dims), lo)
+            inside = np.all((ijk >= lo) & (ijk < hi), axis=1)
+            ijk = ijk[inside] + pads.astype(np.int32)
+            if ijk.shape[0] < no_voxels:
                 print ('Warning: Image', cnt,
-                       'has some voxels that cannot be used:', len(neg_indx[0]))
-            rowlist = np.delete(np.array(range(ijk.shape[0])), neg_indx, 0)
-            index_list.append(ijk[rowlist, :])
+                       'has some voxels that cannot be used:',
+                       no_voxels - ijk.shape[0])
+            index_list.append(ijk)
             cnt += 1
         return index_list
 
     def _collect_patches(self, inpN, outM, inp_images, out_images,
                          pindlistI, pindlistO,
-                         us_rate=2, shuffle=True):
-        dimV = inp_images[0].shape[-1] if len(inp_images[0].shape)==4 else 1
-        psz  = 2*inpN + 1
-        N = pindlistI.shape[0]
-        inp_patches = np.zeros((N, psz, psz, psz, dimV))
-        dimV = out_images[0].shape[-1] if len(out_images[0].shape)==4 else 1
-        psz  = 2*outM + 1 if shuffle else us_rate*(2*outM + 1)
-        out_patches = np.zeros((N, psz, psz, psz, dimV))
-
-        # input patches
-        cnt = 0
-        for r in pindlistI:
-            if len(inp_images[0].shape)==4:
-                inp_patches[cnt, ...] = (
-                                inp_images[r[0]][r[1]-inpN:r[1]+inpN+1,
-                                                 r[2]-inpN:r[2]+inpN+1,
-                                                 r[3]-inpN:r[3]+inpN+1, ...])
-            else:
-                inp_patches[cnt, ..., 0] = (
-                                inp_images[r[0]][r[1]-inpN:r[1]+inpN+1,
-                                                 r[2]-inpN:r[2]+inpN+1,
-                                                 r[3]-inpN:r[3]+inpN+1, ...])
-            cnt += 1
+                         us_rate=2, shuffle=True,
+                         inp_buf=None, out_buf=None):
+        """
+        Gathers the input/output patch pairs of the given patch indices.
 
-        # output patches:
-        c = 1 if shuffle else us_rate
-        cnt = 0
-
-        for r in pindlistO:
-            if len(out_images[0].shape)==4:
-                # print(shuffle, c, outM, r, out_images[r[0]].shape)
-                out_patches[cnt, ...] = (
-                                out_images[r[0]][c*(r[1]-outM):c*(r[1]+outM+1),
-                                                 c*(r[2]-outM):c*(r[2]+outM+1),
-                                                 c*(r[3]-outM):c*(r[3]+outM+1), ...])
-            else:
-                out_patches[cnt, ..., 0] = (
-                                out_images[r[0]][c*(r[1]-outM):c*(r[1]+outM+1),
-                                                 c*(r[2]-outM):c*(r[2]+outM+1),
-                                                 c*(r[3]-outM):c*(r[3]+outM+1), ...])
-            cnt += 1
+        Args:
+            inp_buf, out_buf (np.ndarray): optional batch buffers to fill,
+                                           new arrays are allocated if None
 
+        Returns:
+            inp_patches, out_patches (np.ndarray): 5D arrays of patches
+        """
+        inp_store, out_store = self._get_stores(inp_images, out_images)
+        inp_patches = inp_store.gather(pindlistI, inpN, out=inp_buf)
+        out_patches = out_store.gather(pindlistO, outM, scale=us_rate,
+                                       out=out_buf,
+                                       shuffle=us_rate if shuffle else 1)
         return inp_patches, out_patches
 
+    def _set_images(self, inp_images, out_images, layouts=(None, None)):
+        """
+        Packs the preprocessed images into contiguous volume stores of type
+        self._storage, with the given layouts of their virtual padding (see
+        VolumeStore). self._inp_images/_out_images then hold 4D views into
+        the stores.
+        """
+        self._set_stores(VolumeStore(inp_images, dtype=self._storage,
+                                     layout=layouts[0]),
+                         VolumeStore(out_images, dtype=self._storage,
+                                     layout=layouts[1]))
+
+    def _set_stores(self, inp_store, out_store):
+        self._inp_store = inp_store
+        self._out_store = out_store
+        self._layouts = (inp_store.layout, out_store.layout)
+        self._inp_images = self._inp_store.volumes
+        self._out_images = self._out_store.volumes
+        self._buffers = dict()
+
+    def _get_stores(self, inp_images, out_images):
+        if self._inp_store is None and inp_images is self._inp_images:
+            # e.g. a fully pickled Data: pack the loaded images once
+            self._set_images(list(self._inp_images), list(self._out_images),
+                             self._layouts)
+            inp_images, out_images = self._inp_images, self._out_images
+        if inp_images is self._inp_images and out_images is self._out_images:
+            return self._inp_store, self._out_store
+        return VolumeStore(list(inp_images)), VolumeStore(list(out_images))
+
+    def share_volumes(self, dirname):
+        """
+        Moves the input/output volume stores into memory mapped files in
+        dirname, so that extraction processes share them with this one.
+        """
+        inp_store, out_store = self._get_stores(self._inp_images,
+                                                self._out_images)
+        inp_store.share(os.path.join(dirname, 'inp_volumes.npy'))
+        out_store.share(os.path.join(dirname, 'out_volumes.npy'))
+        self._inp_images = inp_store.volumes
+        self._out_images = out_store.volumes
+        self._buffers = dict()
+
+    def _extraction_state(self):
+        """ The (picklable) state an extraction process is built from """
+        state = dict((key, getattr(self, key)) for key in self._extraction_keys)
+        return state, self._inp_store, self._out_store
+
+    def _new_batch_buffers(self, batch_size):
+        """ Allocates a pair of float32 input/output minibatch buffers """
+        inp_store, out_store = self._get_stores(self._inp_images,
+                                                self._out_images)
+        c = self._us_rate if self._shuffle else 1
+        return (np.empty((batch_size,) + inp_store.patch_shape(self._inpN),
+                         dtype='float32'),
+                np.empty((batch_size,) + out_store.patch_shape(self._outM,
+                                                               self._us_rate, c),
+                         dtype='float32'))
+
+    def _batch_buffers(self, name, batch_size):
+        """ Reusable float32 input/output buffers of a minibatch stream """
+        bufs = self._buffers.get(name)
+        if bufs is None or bufs[0].shape[0] != batch_size:
+            bufs = self._new_batch_buffers(batch_size)
+            self._buffers[name] = bufs
+        return bufs
+
     def _load_selected_patchpair(self, sub_idx, c_1, c_2, c_3,
                                  inpN, outM, us_rate, is_shuffle):
 
-        # load the input patch:
-        inp = self._inp_images[sub_idx][c_1 - inpN:c_1 + inpN + 1,
-                                        c_2 - inpN:c_2 + inpN + 1,
-                                        c_3 - inpN:c_3 + inpN + 1, ...]
-        # get the corresponding output patch:
-        c = 1 if is_shuffle else us_rate
-
-        # print(shuffle, c, outM, r, out_images[r[0]].shape)
-        out = self._out_images[sub_idx][c * (c_1 - outM):c * (c_1 + outM + 1),
-                                        c * (c_2 - outM):c * (c_2 + outM + 1),
-                                        c * (c_3 - outM):c * (c_3 + outM + 1), ...]
+        # load the input patch and the corresponding output patch:
+        pindlist = np.array([[sub_idx, c_1, c_2, c_3]])
+        inp, out = self._collect_patches(inpN, outM,
+                                         self._inp_images, self._out_images,
+                                         pindlist, pindlist,
+                                         us_rate=us_rate, shuffle=is_shuffle)
 
         # normalise the input and output patch:
         inp, out = self._normalise(inp, out)
-        inp = inp[np.newaxis, :]
-        out = out[np.newaxis, :]
 
         return inp, out
 
-    def _select_patch_indices(self, size, vox_indx):
+    def _select_patch_indices(self, size, vox_indx, weights=None):
         """ Select the indices of patches to be extracted
         Args:
             size (int): the total number of patches to be extracted
@@ -485,6 +1448,11 @@ class Data(object):
                             (i,j,k) of all valid patches in each subject.
                             Each row is an instance of patch location (i, j, k).
                             len(vox_idx) = number of subjects.
+            weights (list): optional list of 1d arrays of non-negative
+                            sampling weights, one per row of vox_indx. The
+                            patches of each subject are then drawn without
+                            replacement with probabilities proportional
+                            to the weights.
         Returns:
             pindlist (np array): 4D array which stores the patch identifiers:
                                  Each row is of form [subject_idx, i, j, k].
@@ -497,14 +1465,17 @@ class Data(object):
         pindlist = np.zeros((size, 4), dtype=int)
 
         for idx in range(len(vox_indx)):
-            if not(idx==(len(vox_indx)-1)):
-                pindlist[idx*no_samples:(idx+1)*no_samples,0]=idx # subject idx
-                pindlist[idx*no_samples:(idx+1)*no_samples,1:]\
-                    = np.random.permutation(vox_indx[idx])[:no_samples,:]
+            start = idx*no_samples
+            k = no_samples if idx < len(vox_indx) - 1 else no_samples + reminder
+            if k > vox_indx[idx].shape[0]:
+                raise ValueError('Subject %d has only %d valid patches, %d requested.'
+                                 % (idx, vox_indx[idx].shape[0], k))
+            if weights is None:
+                rows = np.random.permutation(vox_indx[idx].shape[0])[:k]
             else:
-                pindlist[idx*no_samples:,0]=idx
-                pindlist[idx*no_samples:,1:] \
-                    = np.random.permutation(vox_indx[idx])[:(no_samples+reminder),:]
+                rows = _weighted_sample(weights[idx], k)
+            pindlist[start:start + k, 0] = idx # subject idx
+            pindlist[start:start + k, 1:] = vox_indx[idx][rows, :]
             size_total += vox_indx[idx].shape[0]
 
         print('Patch extraction: %d/%d are retrieved.'
@@ -514,6 +1485,79 @@ class Data(object):
         pindlist = pindlist[perm, :]
         return pindlist
 
+    def _sampling_weights(self, method, vox_indx, sample_weights=None,
+                          floor=0.1):
+        """
+        Sampling weights of the valid patch centres of each subject.
+
+        Args:
+            method (str): 'default': uniform sampling (returns None),
+                          'edge': gradient magnitude of the input at the centre,
+                          'anisotropy': fractional anisotropy of the input DTI
+                                        at the centre,
+                          'weighted': values of sample_weights at the centre
+            vox_indx (list): valid centres of each subject
+            sample_weights (list): 3D weight volumes in the space of the
+                                   preprocessed (padded) input images,
+                                   e.g. a loss map of a previous run
+            floor (float): fraction of uniform sampling mixed in, so that
+                           every valid centre can be drawn
+
+        Returns:
+            weights (list): 1d arrays of weights, or None
+        """
+        if method == 'default':
+            return None
+        if method == 'weighted' and sample_weights is None:
+            raise ValueError('Weighted sampling needs sample_weights.')
+        if method not in ('edge', 'anisotropy', 'weighted'):
+            raise ValueError('Unknown sampling method: ' + method)
+
+        inp_store = self._get_stores(self._inp_images, self._out_images)[0]
+        pads, padded_dims = inp_store.layout
+        scales = 1. if inp_store.scales is None else inp_store.scales
+        weights = []
+        for idx, ijk in enumerate(vox_indx):
+            img = self._inp_images[idx]
+            # indices into the stored (not padded) image:
+            i, j, k = inp_store.stored_indices(idx, ijk).T
+            if method == 'edge':
+                # central differences over all channels
+                grad2 = 0.
+                for axis in range(3):
+                    lo, hi = [i, j, k], [i, j, k]
+                    lo[axis] = np.maximum(lo[axis] - 1, -pads[idx, axis])
+                    hi[axis] = np.minimum(hi[axis] + 1,
+                                          padded_dims[idx, axis] - 1 - pads[idx, axis])
+                    diff = (_padded_values(img, hi).astype(np.float64)
+                            - _padded_values(img, lo)) * scales
+                    grad2 = grad2 + np.sum(diff**2, axis=-1)
+                w = np.sqrt(grad2)
+            elif method == 'anisotropy':
+                if img.shape[-1] != 6:
+                    raise ValueError('Anisotropy sampling needs 6-channel DTI inputs.')
+                d = img[i, j, k].astype(np.float64) * scales
+                diag2 = d[:, 0]**2 + d[:, 3]**2 + d[:, 5]**2
+                offd2 = d[:, 1]**2 + d[:, 2]**2 + d[:, 4]**2
+                cross = d[:, 0]*d[:, 3] + d[:, 3]*d[:, 5] + d[:, 5]*d[:, 0]
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    w = np.sqrt(np.maximum(diag2 + 3*offd2 - cross, 0)
+                                / (diag2 + 2*offd2))
+                w[~np.isfinite(w)] = 0
+            else:
+                if sample_weights[idx].shape[:3] != tuple(padded_dims[idx]):
+                    raise ValueError('Weight volume %d has shape %s, not %s'
+                                     % (idx, sample_weights[idx].shape[:3],
+                                        tuple(padded_dims[idx])))
+                w = np.asarray(sample_weights[idx][tuple(ijk.T)],
+                               dtype=np.float64)
+            if np.any(w < 0):
+                raise ValueError('Sampling weights must be non-negative.')
+            mean = w.mean()
+            w = (1 - floor) * w / mean + floor if mean > 0 else np.ones_like(w)
+            weights.append(w)
+        return weights
+
     def _segregate_trainvalid_masks(self, inp_images, inpN, valindlist):
         print ('Segretating validation and training patch-masks')
         masks = []
@@ -535,33 +1579,147 @@ class Data(object):
         return masks
 
     # -------------------- Preprocess the data ---------------------------------
+    def _prepare_volumes(self, inp_images, out_images, inpN, us_rate,
+                         pad_size=-1, clip=True, shuffle=True,
+                         volume_cache=None, subject_info=None):
+        """ Preprocesses and packs the images, or maps them from the cache """
+        if volume_cache and os.path.isfile(os.path.join(volume_cache,
+                                                        'volumes.pkl')):
+            print('Loading preprocessed volumes: ' + volume_cache)
+            self.load_volumes(volume_cache)
+            return
+        inp_images, out_images, layouts = self._preprocess(inp_images,
+                                                           out_images,
+                                                           inpN,
+                                                           us_rate,
+                                                           pad_size=pad_size,
+                                                           clip=clip,
+                                                           shuffle=shuffle,
+                                                           subject_info=subject_info)
+        self._set_images(inp_images, out_images, layouts)
+        if volume_cache:
+            print('Caching preprocessed volumes: ' + volume_cache)
+            self.save_volumes(volume_cache)
+
     def _preprocess(self,
                     inp_images, out_images,
                     inpN,
                     us_rate,
                     pad_size=-1,
                     clip=True,
-                    shuffle=True):
+                    shuffle=True,
+                    subject_info=None):
+        """
+        Clips the images and brings the inputs to low-res space. The hi-res
+        outputs are kept as they are: they are reverse shuffled patch by
+        patch as they are gathered (see VolumeStore.gather). The zero padding
+        is virtual: it is only recorded in the returned layouts (see
+        VolumeStore), and no padded copies of the images are made. The
+        images are first cropped to the bounding box of their non-zero
+        voxels, whose offset goes into the layouts as well, so the patch
+        coordinates stay those of the whole padded volumes. The
+        low-res inputs are compact contiguous arrays, so the hi-res ones can
+        be freed. The entries of inp_images/out_images are (clipped in place
+        and) released as they are processed.
+        The foreground boxes and clipping percentiles are taken from
+        subject_info (see common.subject_manifest) where it has them.
 
-        # pad images:
+        Returns:
+            inp_images, out_images (list): preprocessed volumes
+            layouts (tuple): (pads, dims) of the input and output volumes
+        """
+        # pad images (virtually):
         padding = None if pad_size < 0 else pad_size
-        inp_images, out_images = self._pad_images(inp_images, out_images,
-                                                  us_rate, inpN,
-                                                  padding=padding)
-
-        # clip images at 0.1% and 99.9% percentile:
+        print ('Padding low-res/hi-res images with zeros')
+        if padding is None:
+            print("Apply maximal padding ...")
+        else:
+            print("Pad by: %s" % (padding,))
+        pads = [self._padding(inp.shape, us_rate, inpN, padding)
+                for inp in inp_images]
+
+        # precomputed facts are only trusted for volumes of the same shape:
+        if subject_info:
+            subject_info = list(subject_info)
+            for idx, info in enumerate(subject_info):
+                if info is None:
+                    continue
+                shape = tuple(info.get('shape', ()))
+                if shape[:3] != inp_images[idx].shape[:3]:
+                    print('Warning: the manifest of image %d is for a volume '
+                          'of shape %s, scanning the image instead'
+                          % (idx + 1, shape))
+                    subject_info[idx] = None
+
+        # crop images to the bounding box of their non-zero voxels; the
+        # background beyond it becomes part of the virtual padding:
+        print ('Cropping images to the foreground')
+        before, after = 0, 0
+        for idx, (lo, dims) in enumerate(pads):
+            info = subject_info[idx] if subject_info else None
+            if info is not None and 'box' in info:
+                start, stop = [np.array(b, dtype=np.intp) for b in info['box']]
+            else:
+                start, stop = du.nonzero_box(inp_images[idx], out_images[idx])
+            before += inp_images[idx][..., 0].size
+            after += int(np.prod(stop - start))
+            box = tuple(slice(a, b) for a, b in zip(start, stop))
+            inp_images[idx] = np.ascontiguousarray(inp_images[idx][box])
+            out_images[idx] = np.ascontiguousarray(out_images[idx][box])
+            pads[idx] = (lo + start, dims)
+        print ('Kept %d of %d voxels' % (after, before))
+
+        # clip images at 0.1% and 99.9% percentile (of the foreground, which
+        # the padding does not change):
         if clip: inp_images, out_images = self._clip_images(inp_images,
-                                                            out_images)
+                                                            out_images,
+                                                            subject_info=subject_info)
 
         # bring all images to low-res space
-        inp_images = self._downsample_lowres(inp_images, us_rate)
-
-        # reverse-shuffle output images
-        if shuffle: out_images = du.backward_shuffle_img(out_images, us_rate)
+        print ('Downsampling low-res images')
+        inp_lr, inp_layout = [], ([], [])
+        for idx, (lo, dims) in enumerate(pads):
+            # first hi-res voxel on the low-res grid of the padded image:
+            first = (-lo) % us_rate
+            inp_lr.append(np.ascontiguousarray(
+                inp_images[idx][first[0]::us_rate,
+                                first[1]::us_rate,
+                                first[2]::us_rate]))
+            inp_images[idx] = None
+            inp_layout[0].append((lo + first) // us_rate)
+            inp_layout[1].append(dims // us_rate)
+
+        # output images stay in hi-res space:
+        out_lr, out_layout = [], ([], [])
+        for idx, (lo, dims) in enumerate(pads):
+            out_lr.append(out_images[idx])
+            out_layout[0].append(lo)
+            out_layout[1].append(dims)
+            out_images[idx] = None
+
+        return inp_lr, out_lr, (inp_layout, out_layout)
+
+    def _padding(self, shape, us_rate, inpN, padding=None):
+        """
+        Zero padding of an image before patch extraction: padding on each
+        side (maximal if None), plus extra voxels at the end of each axis
+        so that the padded image is divisible by the upsampling rate.
 
-        return inp_images, out_images
+        Returns:
+            lo (np.ndarray): padding at the start of each axis
+            dims (np.ndarray): spatial shape of the padded image
+        """
+        if padding is None:
+            pad_min = np.array([(inpN + 1) * us_rate] * 3, dtype=np.intp)
+        else:
+            if type(padding) == int: padding = (padding,) * 3
+            pad_min = np.array(padding, dtype=np.intp)
+        sh = np.array(shape[:3], dtype=np.intp)
+        pad_max = pad_min + np.mod(-(2 * pad_min + sh), us_rate)
+        return pad_min, sh + pad_min + pad_max
 
-    def _compute_normalisation_transform(self, whiten, inp_images, out_images, compute_tfm, us_rate):
+    def _compute_normalisation_transform(self, whiten, inp_images, out_images, compute_tfm, us_rate,
+                                         stats_samples=10000):
         # Compute the normalisation parameters:
         if compute_tfm:
             if whiten == 'none':
@@ -581,64 +1739,82 @@ class Data(object):
             elif whiten == 'standard':
                 print('Whiten each channel independently.')
                 transform = dict()
-                in_m, in_s, out_m, out_s = self._compute_mean_and_std()
+                in_m, in_s, out_m, out_s = self._compute_mean_and_std(n_samples=stats_samples)
                 transform['input_mean'] = in_m
                 transform['input_std'] = in_s
                 transform['output_mean'] = out_m
                 transform['output_std'] = out_s
         return transform
 
-    def _compute_mean_and_std(self, n_chunks=100, chunk_size=100):
-        # # Get the indices of samples used for computing mean and std:
-        # perm = np.arange(self._size)
-        # np.random.shuffle(perm)
-        # samples_list = perm[:no_samples]
-
-        # Compute:
-        sum_in, sum_in2, sum_out, sum_out2 = 0, 0, 0, 0
-
-        for i in xrange(n_chunks):
-            sys.stdout.write('\tChunk progress: %d/%d\r' % (i + 1, n_chunks))
-            sys.stdout.flush()
-
-            pindlist1 = self._train_pindlistI[
-                        i * chunk_size:(i + 1) * chunk_size, :]
-            pindlist2 = self._train_pindlistO[
-                        i * chunk_size:(i + 1) * chunk_size, :]
-
-            inp_chunk, out_chunk = self._collect_patches(self._inpN,
-                                                         self._outM,
-                                                         self._inp_images,
-                                                         self._out_images,
-                                                         pindlist1, pindlist2,
-                                                         us_rate=self._us_rate,
-                                                         shuffle=self._shuffle
-                                                         )
-
-            sum_in += 1. * np.sum(inp_chunk, axis=0)
-            sum_in2 += 1. * np.sum(inp_chunk ** 2, axis=0)
-            sum_out += 1. * np.sum(out_chunk, axis=0)
-            sum_out2 += 1. * np.sum(out_chunk ** 2, axis=0)
-
-        in_m = sum_in / (n_chunks * chunk_size)
-        in_s = np.sqrt(
-            (sum_in2 - 2 * in_m * sum_in + n_chunks * chunk_size * (in_m ** 2)) \
-            / (n_chunks * chunk_size))
-
-        out_m = sum_out / (n_chunks * chunk_size)
-        out_s = np.sqrt((
-                        sum_out2 - 2 * out_m * sum_out + n_chunks * chunk_size * (
-                        out_m ** 2)) \
-                        / (n_chunks * chunk_size))
+    def _compute_mean_and_std(self, n_samples=10000, chunk_size=100,
+                              no_workers=4):
+        """
+        Voxel- and channel-wise mean and std of the input/output training
+        patches. The moments of each chunk of patches are merged into the
+        running ones (Chan et al.'s parallel update of Welford's algorithm),
+        which unlike a sum of squares stays accurate for any number of
+        patches. Chunks are extracted in parallel and merged in order.
+
+        Args:
+            n_samples (int): number of training patches to use, from the
+                             start of the list (drawn from the stream in
+                             streaming mode). None or <= 0 to use all.
+            chunk_size (int): number of patches per chunk
+            no_workers (int): number of extraction threads
+
+        Returns:
+            in_m, in_s, out_m, out_s (np.ndarray): means and stds
+        """
+        n_total = self._size if self._streaming else self._train_pindlistI.shape[0]
+        if n_samples is None or n_samples <= 0 or n_samples > n_total:
+            n_samples = n_total
+        starts = range(0, n_samples, chunk_size)
+        n_chunks = len(starts)
+        indices = self._train_indices
+        if self._streaming:
+            # a fixed sample of the training stream, the same in every load
+            # of the library (and in every shard):
+            rng = np.random.RandomState([self._stats_seed, 4])
+            sample = self._draw_stream_centres(rng, n_samples)
+            indices = lambda rows: (sample[rows], sample[rows])
+
+        def chunk_moments(start):
+            end = min(start + chunk_size, n_samples)
+            pindlist1, pindlist2 = indices(slice(start, end))
+            inp_chunk, out_chunk = self._collect_patches(
+                self._inpN, self._outM, self._inp_images, self._out_images,
+                pindlist1, pindlist2,
+                us_rate=self._us_rate, shuffle=self._shuffle)
+            return _moments(inp_chunk), _moments(out_chunk)
+
+        # build the volume stores before the threads use them:
+        self._get_stores(self._inp_images, self._out_images)
+        pool = multiprocessing.pool.ThreadPool(max(no_workers, 1))
+        try:
+            inp_mom, out_mom = None, None
+            for i, (inp_chunk, out_chunk) in enumerate(
+                    pool.imap(chunk_moments, starts)):
+                sys.stdout.write('\tChunk progress: %d/%d\r' % (i + 1, n_chunks))
+                sys.stdout.flush()
+                inp_mom = _merge_moments(inp_mom, inp_chunk)
+                out_mom = _merge_moments(out_mom, out_chunk)
+        finally:
+            pool.close()
+            pool.join()
+
+        in_m, in_s = inp_mom[1], np.sqrt(inp_mom[2] / inp_mom[0])
+        out_m, out_s = out_mom[1], np.sqrt(out_mom[2] / out_mom[0])
         return in_m, in_s, out_m, out_s
 
-    def _normalise(self, inp, out):
+    def _normalise(self, inp, out, in_place=False):
         inp = self._diag_whiten(inp,
                                 self._transform['input_mean'],
-                                self._transform['input_std'])
+                                self._transform['input_std'],
+                                in_place=in_place)
         out = self._diag_whiten(out,
                                 self._transform['output_mean'],
-                                self._transform['output_std'])
+                                self._transform['output_std'],
+                                in_place=in_place)
 
         return inp, out
 
@@ -656,107 +1832,18 @@ class Data(object):
 
         return inp, out, out_pred, out_std
 
-    def _diag_whiten(self, mini_batch, mean, std):
-        return (mini_batch - mean)/std
+    def _diag_whiten(self, mini_batch, mean, std, in_place=False):
+        if not in_place:
+            return (mini_batch - mean)/std
+        mini_batch -= mean
+        mini_batch /= std
+        return mini_batch
 
-    def _pad_images(self, inp_images, out_images, us_rate, inpN, padding=None):
-        """
-        Pad images with zeros if required.
-
-        Returns:
-            inp_pad, out_pad: padded images (not in place)
-        """
-        print ('Padding low-res/hi-res images with zeros')
-        inp_pad = []
-        out_pad = []
-
-        # set the padding:
-        if padding == None:
-            print("Apply maximal padding ...")
-            pad_min_x, pad_min_y, pad_min_z = (inpN + 1) * us_rate, (
-            inpN + 1) * us_rate, (inpN + 1) * us_rate
-        else:
-            if type(padding) == int: padding = (padding,) * 3
-            print("Pad by: %s" % (padding,))
-            pad_min_x, pad_min_y, pad_min_z = padding
-
-        # start padding:
-        for inp, out in zip(inp_images, out_images):
-            sh = inp.shape
-            # add extra padding so padded images are divisible
-            # by upsampling factor in all dimns
-            pad_x = pad_min_x if np.mod(2 * pad_min_x + sh[0], us_rate) == 0 \
-                else pad_min_x + (us_rate - np.mod(2 * pad_min_x + sh[0], us_rate))
-
-            pad_y = pad_min_y if np.mod(2 * pad_min_y + sh[1], us_rate) == 0 \
-                else pad_min_y + (us_rate - np.mod(2 * pad_min_y + sh[1], us_rate))
-
-            pad_z = pad_min_z if np.mod(2 * pad_min_z + sh[2], us_rate) == 0 \
-                else pad_min_z + (us_rate - np.mod(2 * pad_min_z + sh[2], us_rate))
-
-            # padd the images:
-            if len(sh)==3:
-                inp = np.pad(inp,
-                             pad_width=((pad_min_x, pad_x),
-                                        (pad_min_y, pad_y),
-                                        (pad_min_z, pad_z)),
-                             mode='constant', constant_values=0)
-            elif len(sh)==4:
-                inp = np.pad(inp,
-                             pad_width=((pad_min_x, pad_x),
-                                        (pad_min_y, pad_y),
-                                        (pad_min_z, pad_z), (0, 0)),
-                             mode='constant', constant_values=0)
-            else:
-                raise ValueError('Only 3D or 4D images')
-            inp_pad.append(inp)
-
-            sh = out.shape
-            if len(sh)==3:
-                out = np.pad(out,
-                             pad_width=((pad_min_x, pad_x),
-                                        (pad_min_y, pad_y),
-                                        (pad_min_z, pad_z)),
-                             mode='constant', constant_values=0)
-            elif len(sh)==4:
-                out = np.pad(out,
-                             pad_width=((pad_min_x, pad_x),
-                                        (pad_min_y, pad_y),
-                                        (pad_min_z, pad_z), (0, 0)),
-                             mode='constant', constant_values=0)
-            else:
-                raise ValueError('Only 3D or 4D images')
-            out_pad.append(out)
-
-        return inp_pad, out_pad
-
-
-    def _downsample_lowres(self, lr_images, us_rate):
-        """ Down-sample
-        Returns:
-            ds_images: downsampled images
-        """
-        print ('Downsampling low-res images')
-        is3D = True
-        if len(lr_images[0].shape) == 3: pass
-        elif len(lr_images[0].shape) == 4:
-            is3D = False
-        else:
-            raise ValueError('Only 3D or 4D images')
-
-        ds_images = []
-        for img in lr_images:
-            if is3D:
-                img = img[::us_rate, ::us_rate, ::us_rate]
-            else:
-                img = img[::us_rate, ::us_rate, ::us_rate, ...]
-            ds_images.append(img)
-
-        return ds_images
-
-
-    def _clip_images(self, inp_images, out_images, tail_perc=0.1, head_perc=99.9):
+    def _clip_images(self, inp_images, out_images, tail_perc=0.1, head_perc=99.9,
+                     no_workers=4, subject_info=None):
         """ Clip inp_images, out_images according to the specified percentile.
+        The percentiles of each channel are taken over the foreground
+        (non-zero first channel), and the images are clipped in place.
 
         Assumptions:
             input_images, out_images are in the original form (with no shuffling).
@@ -765,30 +1852,471 @@ class Data(object):
             out_images (list): list of output images
             tail_perc (float): lower percentile
             head_perc (float): upper percentile
+            no_workers (int): number of images clipped at a time
+            subject_info (list): optional precomputed percentiles of each
+                                 subject (see common.subject_manifest)
         """
         print("Clipping input/output images")
-        inp_perc_list, out_perc_list=[],[]
 
+        def clip(job):
+            img, bounds = job
+            assert img.ndim == 4
+            du.clip_percentiles(img, img[..., 0] != 0, tail_perc, head_perc,
+                                bounds=bounds)
+
+        jobs = []
         for idx, (inp, out) in enumerate(zip(inp_images, out_images)):
             assert inp.shape == out.shape
-            inp_mask = inp[..., 0] != 0
-            out_mask = out[..., 0] != 0
-
-            for ch_idx in range(inp.shape[-1]):
-                v_ch = inp[..., ch_idx][inp_mask]
-                inp_perc_tail = np.percentile(v_ch,tail_perc)
-                inp_perc_head = np.percentile(v_ch,head_perc)
-                inp_perc_list.append((inp_perc_tail,inp_perc_head))
-                inp_images[idx][...,ch_idx][inp_mask]=np.clip(v_ch,
-                                                              inp_perc_tail,
-                                                              inp_perc_head)
-
-                v_ch = out[..., ch_idx][out_mask]
-                out_perc_tail = np.percentile(v_ch, tail_perc)
-                out_perc_head = np.percentile(v_ch, head_perc)
-                out_perc_list.append((out_perc_tail, out_perc_head))
-                out_images[idx][..., ch_idx][out_mask] = np.clip(v_ch,
-                                                                 out_perc_tail,
-                                                                 out_perc_head)
-        assert len(inp_perc_list)==len(out_perc_list)
+            info = subject_info[idx] if subject_info else None
+            clips = info.get('clip', {}) if info is not None else {}
+            bounds = clips.get(clip_key(tail_perc, head_perc), {})
+            jobs += [(inp, bounds.get('inp')), (out, bounds.get('out'))]
+        # subjects are clipped concurrently (numpy releases the GIL):
+        pool = multiprocessing.pool.ThreadPool(max(min(no_workers, len(inp_images)), 1))
+        try:
+            pool.map(clip, jobs)
+        finally:
+            pool.close()
+            pool.join()
         return inp_images, out_images
+
+
+class Prefetcher(object):
+    """
+    Background minibatch loader around a Data instance.
+
+    Worker threads extract the training and validation minibatches ahead of
+    time into a bounded pool of buffers, so that patch extraction overlaps
+    with the TensorFlow step. The index bookkeeping stays sequential, hence
+    minibatches come out in exactly the order the wrapped Data would have
+    produced them, and are reproducible if a seed is given.
+
+    With processes=True each worker thread hands the extraction over to its
+    own process instead. The volume stores are then moved into memory mapped
+    files that all processes share, and the minibatches are written into
+    shared memory buffers, so neither volumes nor batches are pickled.
+
+    next_batch/next_val_batch/epochs_completed mirror Data; any other
+    attribute is looked up on the wrapped dataset.
+    """
+    def __init__(self, dataset, batch_size, queue_size=4, no_workers=2,
+                 seed=None, processes=False, shared_dir=None):
+        """
+        Args:
+            dataset (Data): patch library to draw minibatches from
+            batch_size (int): minibatch size of both streams
+            queue_size (int): number of minibatches extracted ahead per stream
+            no_workers (int): number of extraction threads (or processes)
+                              per stream
+            seed (int): if given, seeds the reshuffling of the dataset
+            processes (bool): extract in worker processes instead of threads
+            shared_dir (str): directory of the memory mapped volumes, by
+                              default a new folder in /dev/shm (if present)
+                              or in the system temporary directory. Unused
+                              if the volumes are memory mapped already.
+        """
+        if seed is not None:
+            dataset.set_seed(seed)
+        # build the volume stores before any worker touches them:
+        dataset._get_stores(dataset._inp_images, dataset._out_images)
+        self._dataset = dataset
+        self._batch_size = batch_size
+        self._epochs_completed = dataset.epochs_completed
+        self._shared_dir = None
+        self._train = None
+        self._valid = None
+        # a run that dies before stop() must not leave the shared volumes in
+        # /dev/shm or the extraction processes behind:
+        atexit.register(_stop_prefetcher, weakref.ref(self))
+        queue_size = max(queue_size, 1)
+        no_workers = max(no_workers, 1)
+        # materialised patches are sliced, not extracted:
+        with_train = dataset._train_patches is None
+        with_valid = dataset.size_valid >= batch_size and \
+            dataset._val_patches is None
+
+        # start all the processes before any thread is running:
+        pools = [None, None]
+        if processes and (with_train or with_valid):
+            if not (dataset._inp_store.shared and dataset._out_store.shared):
+                if shared_dir is None:
+                    shared_dir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+                self._shared_dir = tempfile.mkdtemp(prefix='patchlib_',
+                                                    dir=shared_dir)
+                dataset.share_volumes(self._shared_dir)
+            for idx, used in enumerate((with_train, with_valid)):
+                if used:
+                    pools[idx] = _ExtractionPool(dataset, batch_size,
+                                                 queue_size + 1, no_workers)
+
+        if with_train:
+            self._train = _BatchStream(dataset, dataset._draw_train_job,
+                                       batch_size, queue_size, no_workers,
+                                       with_epochs=True, pool=pools[0])
+        if with_valid:
+            self._valid = _BatchStream(dataset, dataset._draw_val_job,
+                                       batch_size, queue_size, no_workers,
+                                       pool=pools[1])
+
+    def __getattr__(self, name):
+        # only called for attributes not found on the Prefetcher itself
+        return getattr(self.__dict__['_dataset'], name)
+
+    @property
+    def epochs_completed(self):
+        return self._epochs_completed
+
+    def next_batch(self, batch_size):
+        """
+        Returns the next prefetched training minibatch (input, output).
+        The arrays stay valid until the next call to next_batch.
+        """
+        assert batch_size == self._batch_size
+        if self._train is None:
+            inp, out = self._dataset.next_batch(batch_size)
+            self._epochs_completed = self._dataset.epochs_completed
+            return inp, out
+        inp, out, self._epochs_completed = self._train.get()
+        return inp, out
+
+    def next_val_batch(self, batch_size):
+        """
+        Returns the next prefetched validation minibatch (input, output).
+        The arrays stay valid until the next call to next_val_batch.
+        """
+        assert batch_size == self._batch_size
+        if self._valid is None:
+            return self._dataset.next_val_batch(batch_size)
+        inp, out, _ = self._valid.get()
+        return inp, out
+
+    def stop(self):
+        """ Stops the workers and removes the shared volume files """
+        if self._train is not None:
+            self._train.stop()
+            self._train = None
+        if self._valid is not None:
+            self._valid.stop()
+            self._valid = None
+        if self._shared_dir is not None:
+            # the dataset keeps its mappings, the pages outlive the files
+            shutil.rmtree(self._shared_dir, ignore_errors=True)
+            self._shared_dir = None
+
+
+def _stop_prefetcher(ref):
+    prefetcher = ref()
+    if prefetcher is not None:
+        prefetcher.stop()
+
+
+class _BatchStream(object):
+    """
+    One prefetched minibatch stream of a Prefetcher.
+
+    Each minibatch gets a ticket when its patch indices are drawn; workers
+    extract tickets in parallel and get() hands them out in ticket order.
+    """
+    def __init__(self, dataset, draw, batch_size, queue_size, no_workers,
+                 with_epochs=False, pool=None):
+        self._dataset = dataset
+        self._draw = draw
+        self._batch_size = batch_size
+        self._queue_size = max(queue_size, 1)
+        self._with_epochs = with_epochs
+        self._pool = pool
+        self._cond = threading.Condition()
+        # one extra buffer pair is held by the consumer:
+        if pool is not None:
+            self._buffers = pool.buffers
+        else:
+            self._buffers = [dataset._new_batch_buffers(batch_size)
+                             for _ in range(self._queue_size + 1)]
+        self._free = list(range(len(self._buffers)))
+        self._held = None
+        self._ready = dict()
+        self._next_ticket = 0
+        self._next_out = 0
+        self._error = None
+        self._stopped = False
+        self._workers = []
+        for idx in range(max(no_workers, 1)):
+            worker = threading.Thread(target=self._work, args=(idx,))
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def _work(self, worker_idx):
+        while True:
+            with self._cond:
+                while not self._stopped and (
+                        not self._free or
+                        self._next_ticket - self._next_out >= self._queue_size):
+                    self._cond.wait()
+                if self._stopped:
+                    return
+                ticket = self._next_ticket
+                self._next_ticket += 1
+                slot = self._free.pop()
+                try:
+                    job = self._draw(self._batch_size)
+                    epochs = self._dataset.epochs_completed \
+                        if self._with_epochs else None
+                except Exception as e:
+                    self._error = e
+                    self._cond.notify_all()
+                    return
+            try:
+                if self._pool is None:
+                    self._dataset._extract_batch(job, self._buffers[slot])
+                else:
+                    self._pool.extract(worker_idx, job, slot)
+            except Exception as e:
+                with self._cond:
+                    self._error = e
+                    self._cond.notify_all()
+                return
+            with self._cond:
+                self._ready[ticket] = (slot, epochs)
+                self._cond.notify_all()
+
+    def get(self):
+        with self._cond:
+            if self._held is not None:
+                self._free.append(self._held)
+                self._held = None
+                self._cond.notify_all()
+            while self._next_out not in self._ready:
+                if self._error is not None:
+                    raise self._error
+                self._cond.wait()
+            slot, epochs = self._ready.pop(self._next_out)
+            self._next_out += 1
+            self._held = slot
+            self._cond.notify_all()
+        inp, out = self._buffers[slot]
+        return inp, out, epochs
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        if self._pool is not None:
+            self._pool.stop()
+
+
+class _ExtractionPool(object):
+    """
+    Extraction processes of one minibatch stream, one per worker thread.
+
+    The minibatch buffers live in shared memory; a worker thread sends the
+    patch indices and a buffer slot to its process and waits for the reply.
+    """
+    def __init__(self, dataset, batch_size, no_slots, no_procs):
+        inp, out = dataset._new_batch_buffers(1)
+        inp_shape = (batch_size,) + inp.shape[1:]
+        out_shape = (batch_size,) + out.shape[1:]
+        raws = [(_shared_raw(inp_shape), _shared_raw(out_shape))
+                for _ in range(no_slots)]
+        self.buffers = [(_shared_view(raw_inp, inp_shape),
+                         _shared_view(raw_out, out_shape))
+                        for raw_inp, raw_out in raws]
+        state = dataset._extraction_state()
+        self._conns = []
+        self._procs = []
+        for _ in range(no_procs):
+            conn, child_conn = multiprocessing.Pipe()
+            proc = multiprocessing.Process(
+                target=_extraction_worker,
+                args=(child_conn, state, raws, inp_shape, out_shape))
+            proc.daemon = True
+            proc.start()
+            child_conn.close()
+            self._conns.append(conn)
+            self._procs.append(proc)
+
+    def extract(self, worker_idx, job, slot):
+        """ Extracts a minibatch job into buffer slot in process worker_idx """
+        conn = self._conns[worker_idx]
+        conn.send((job, slot))
+        error = conn.recv()
+        if error is not None:
+            raise error
+
+    def stop(self):
+        for conn in self._conns:
+            try:
+                conn.send(None)
+            except (IOError, EOFError):
+                pass
+        for proc in self._procs:
+            proc.join(5)
+            if proc.is_alive():
+                proc.terminate()
+
+
+def _signed_permutations():
+    """
+    The 48 symmetries of the voxel grid as (perm, signs): new axis a is old
+    axis perm[a], reversed if signs[a] < 0, i.e. R[a, perm[a]] = signs[a].
+    """
+    symmetries = []
+    for perm in itertools.permutations(range(3)):
+        for signs in itertools.product((1, -1), repeat=3):
+            symmetries.append((perm, signs))
+    return symmetries
+
+
+def _symmetry_det(perm, signs):
+    rot = np.zeros((3, 3))
+    rot[range(3), perm] = signs
+    return np.linalg.det(rot)
+
+
+_SYMMETRY_GROUPS = {
+    'flip': [(p, s) for p, s in _signed_permutations() if p == (0, 1, 2)],
+    'rotate': [(p, s) for p, s in _signed_permutations()
+               if _symmetry_det(p, s) > 0],
+    'all': _signed_permutations()}
+
+# [Dxx, Dxy, Dxz, Dyy, Dyz, Dzz] channel order of the tensors:
+_DT_COMPONENTS = [(0, 0), (0, 1), (0, 2), (1, 1), (1, 2), (2, 2)]
+
+
+def _dt_channel_map(perm, signs):
+    """ 6x6 matrix M with vec(R D R^T) = M vec(D) for a symmetry R """
+    mat = np.zeros((6, 6), dtype=np.float32)
+    for u, (a, b) in enumerate(_DT_COMPONENTS):
+        src = tuple(sorted((perm[a], perm[b])))
+        mat[u, _DT_COMPONENTS.index(src)] = signs[a] * signs[b]
+    return mat
+
+
+def _transform_dti_patches(batch, codes, symmetries, us_rate=1):
+    """
+    Applies the symmetry symmetries[codes[n]] to the DTI patch batch[n], in
+    place, about the patch centre. All patches are cubic. For shuffled
+    output patches (us_rate > 1) the hi-res patches are transformed.
+
+    Args:
+        batch (np.ndarray): (N, side, side, side, 6 * us_rate**3) patches
+        codes (np.ndarray): N indices into symmetries
+        symmetries (list): (perm, signs) pairs, see _signed_permutations
+        us_rate (int): upsampling rate of shuffled patches, 1 otherwise
+    """
+    us = us_rate
+    if us > 1:
+        hr = du.forward_shuffle_batch(batch, us)
+    else:
+        hr = batch.copy()
+    for code in np.unique(codes):
+        perm, signs = symmetries[code]
+        if perm == (0, 1, 2) and signs == (1, 1, 1):
+            continue
+        rows = np.flatnonzero(codes == code)
+        flips = (slice(None),) + tuple(slice(None, None, sg) for sg in signs)
+        hr[rows] = hr[rows].transpose((0,) + tuple(1 + p for p in perm) + (4,))[flips]
+    mats = np.array([_dt_channel_map(*sym) for sym in symmetries])
+    hr = np.einsum('nkc,n...c->n...k', mats[codes], hr)
+    if us > 1:
+        du.backward_shuffle_batch(hr, us, out=batch)
+    else:
+        batch[...] = hr
+
+
+def clip_key(tail_perc, head_perc):
+    """ Key of the clipping percentiles in a subject's info (see _clip_images) """
+    return '%g-%g' % (tail_perc, head_perc)
+
+
+def _padded_values(img, ijk):
+    """ Voxels of img at the index arrays ijk, zero outside of the image """
+    inside = np.ones(ijk[0].shape, dtype=bool)
+    for axis, c in enumerate(ijk):
+        inside &= (c >= 0) & (c < img.shape[axis])
+    vals = np.zeros(ijk[0].shape + img.shape[3:], dtype=img.dtype)
+    vals[inside] = img[tuple(c[inside] for c in ijk)]
+    return vals
+
+
+def _weighted_sample(weights, k):
+    """
+    Draws k distinct indices with probabilities proportional to weights,
+    keeping the k largest keys log(u)/w (Efraimidis & Spirakis, 2006).
+    Linear in the number of candidates, no permutation of them is built.
+    """
+    weights = np.asarray(weights, dtype=np.float64)
+    if k > np.count_nonzero(weights > 0):
+        raise ValueError('Fewer than %d patches with positive weight.' % k)
+    if k == 0:
+        return np.zeros(0, dtype=np.intp)
+    with np.errstate(divide='ignore'):
+        keys = np.log(np.random.random_sample(weights.shape[0])) / weights
+    return np.argpartition(keys, -k)[-k:]
+
+
+def _moments(batch):
+    """ (count, mean, sum of squared deviations) over the first axis """
+    batch = batch.astype(np.float64)
+    mean = batch.mean(axis=0)
+    batch -= mean
+    return batch.shape[0], mean, np.einsum('i...,i...->...', batch, batch)
+
+
+def _merge_moments(a, b):
+    """ Merges two sets of moments (Chan et al. 1979) """
+    if a is None:
+        return b
+    n_a, mean_a, m2_a = a
+    n_b, mean_b, m2_b = b
+    n = n_a + n_b
+    delta = mean_b - mean_a
+    mean = mean_a + delta * (float(n_b) / n)
+    m2 = m2_a + m2_b + delta ** 2 * (float(n_a) * n_b / n)
+    return n, mean, m2
+
+
+def _scratch_memmap(shape, dirname=None, dtype='float32'):
+    """ Array in an anonymous memory mapped .npy file """
+    fd, filename = tempfile.mkstemp(suffix='.npy', dir=dirname)
+    os.close(fd)
+    arr = np.lib.format.open_memmap(filename, mode='w+', dtype=dtype,
+                                    shape=shape)
+    # the mapping keeps the data alive:
+    os.remove(filename)
+    return arr
+
+
+def _shared_raw(shape, dtype='float32'):
+    """ Unsynchronised shared memory block for an array of given shape """
+    nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    return multiprocessing.sharedctypes.RawArray('b', nbytes)
+
+
+def _shared_view(raw, shape, dtype='float32'):
+    return np.frombuffer(raw, dtype=dtype).reshape(shape)
+
+
+def _extraction_worker(conn, state, raws, inp_shape, out_shape):
+    """ Main loop of an extraction process """
+    state, inp_store, out_store = state
+    dataset = Data()
+    dataset.__dict__.update(state)
+    dataset._inp_store, dataset._out_store = inp_store, out_store
+    dataset._inp_images = inp_store.volumes
+    dataset._out_images = out_store.volumes
+    buffers = [(_shared_view(raw_inp, inp_shape),
+                _shared_view(raw_out, out_shape)) for raw_inp, raw_out in raws]
+    while True:
+        try:
+            msg = conn.recv()
+        except (IOError, EOFError):
+            return
+        if msg is None:
+            return
+        job, slot = msg
+        try:
+            dataset._extract_batch(job, buffers[slot])
+            conn.send(None)
+        except Exception as e:
+            conn.send(e)
@@ -21,64 +21,31 @@ import matplotlib.patches as patches
 
 # Load in a DT volume .nii:
 def read_dt_volume(nameroot='/Users/ryutarotanno/DeepLearning/Test_1/data/dt_b1000_',
-                   no_channels=6):
+                   no_channels=6, dtype='float64'):
+    """ Each channel is read straight into the returned 4D volume of type dtype """
     # Append file number to end of file name
-    if no_channels > 7:
-        file_1 = nameroot + '01.nii'
-        file_2 = nameroot + '02.nii'
-    else:
-        file_1 = nameroot + str(1) + '.nii'
-        file_2 = nameroot + str(2) + '.nii'
+    fmt = "{:02d}.nii" if no_channels > 7 else "{:d}.nii"
+    file_1 = nameroot + fmt.format(1)
+    file_2 = nameroot + fmt.format(2)
 
+    first = 1
     if not(os.path.exists(file_1)) or not(os.path.exists(file_2)):
         # previous reconstruction scripts only saved the diffusion tensor components
         # i.e. dt_recon_3.nii, ..., dt_recon_8.nii, so missing dt_recon_1.nii and 2.nii
         print(file_1 + ' does not exist ... set it zeros')
-        for idx in np.arange(3, no_channels+3):
-
-            if no_channels > 7:
-                data_path_new = nameroot + "{:02d}.nii".format(idx)
-            else:
-                data_path_new = nameroot + "{:d}.nii".format(idx)
-
-            print("... loading %s" % data_path_new)
+        first = 3
 
-            img = nib.load(data_path_new)
-            data = img.get_data()
-            data_array = np.zeros(data.shape)
-            data_array[:] = data[:]
+    dti = None
+    for idx in np.arange(first, no_channels+3):
+        data_path_new = nameroot + fmt.format(idx)
+        print("... loading %s" % data_path_new)
 
-            if idx == 3:
-                dti = np.zeros(data.shape + (no_channels+2,))
-                dti[:, :, :, idx - 1] = data_array
-            else:
-                dti[:, :, :, idx - 1] = data_array
-
-            del img, data, data_array
-        return dti
-
-    else:
-        for idx in np.arange(1, no_channels+3):
-            if no_channels > 7:
-                data_path_new = nameroot + "{:02d}.nii".format(idx)
-            else:
-                data_path_new = nameroot + "{:d}.nii".format(idx)
-
-            print("... loading %s" % data_path_new)
-
-            img = nib.load(data_path_new)
-            data = img.get_data()
-            data_array = np.zeros(data.shape)
-            data_array[:] = data[:]
-
-            if idx == 1:
-                dti = np.zeros(data.shape + (no_channels+2,))
-                dti[:, :, :, idx-1] = data_array
-            else:
-                dti[:, :, :, idx-1] = data_array
-
-            del img, data, data_array
-        return dti
+        img = nib.load(data_path_new)
+        if dti is None:
+            dti = np.zeros(img.shape + (no_channels+2,), dtype=dtype)
+        dti[..., idx-1] = np.asanyarray(img.dataobj)
+        del img
+    return dti
 
 
 # Select the patch-library and load into tensor shared variables:
@@ -487,104 +454,53 @@ def mean_and_std_MD_FA(dti_mean, dti_std, no_samples):
 
 
 # Shuffling operation:
-def forward_periodic_shuffle(patch, upsampling_rate=2):
+def forward_periodic_shuffle(patch, upsampling_rate=2, out=None):
     """ This is the 3D extension of periodic shuffling (equation (4) in Magic Pony CVPR 2016).
+    Channel c*us^3 + (k*us + j)*us + i of low-res voxel (x, y, z) goes to channel c
+    of hi-res voxel (us*x + i, us*y + j, us*z + k) (c*us^2 + j*us + i for 2D images).
+    The shuffle is done with a single reshape/transpose copy.
+
     Args:
-        patch (numpy array): 3 or 4 dimensional array with the last dimension being the dt components
+        patch (numpy array): 3, 4 or 5 (batch) dimensional array with the last
+                             dimension being the dt components
         upsampling_rate (int): upsampling rate
+        out (numpy array): optional output array to write into (e.g. a slice of
+                           the hi-res volume); a new one is allocated if None
 
     Returns:
+        patch_ps (numpy array): the shuffled patch, of the same dtype as the input
+                                (or out)
     """
-    if patch.ndim == 3:
-        if patch.shape[2] == (upsampling_rate ** 2):
-            dim_i, dim_j, dim_filters = patch.shape
-            # apply periodic shuffling:
-            patch_ps = np.ndarray((dim_i * upsampling_rate,
-                                  dim_j * upsampling_rate),
-                                  dtype='float64')
-
-            # Apply reverse shuffling (optional):
-            shuffle_indices = [(i, j)
-                               for j in xrange(upsampling_rate)
-                               for i in xrange(upsampling_rate)]
-
-            no_channels = dim_filters / (upsampling_rate ** 3)
-
-            for (i, j) in shuffle_indices:
-                patch_ps[i::upsampling_rate,
-                         j::upsampling_rate] \
-                    = patch[:, :, np.mod(i, upsampling_rate) +
-                                  np.mod(j, upsampling_rate) * upsampling_rate]
-
-        else:
-            dim_i, dim_j, dim_filters = patch.shape
-
-            # apply periodic shuffling:
-            patch_ps = np.ndarray((dim_i * upsampling_rate,
-                                   dim_j * upsampling_rate,
-                                   dim_filters / (upsampling_rate**2)), dtype='float64')
-
-            shuffle_indices = [(i, j)
-                               for j in xrange(upsampling_rate)
-                               for i in xrange(upsampling_rate)]
-
-            no_channels = dim_filters / (upsampling_rate ** 2)
-
-            for c in xrange(dim_filters // (upsampling_rate ** 2)):
-                for (i, j) in shuffle_indices:
-                    patch_ps[i::upsampling_rate,
-                             j::upsampling_rate,
-                             c] = patch[:, :, np.mod(i, upsampling_rate) +
-                                              np.mod(j, upsampling_rate) * upsampling_rate +
-                                              c * (upsampling_rate**2)]
-
-    elif patch.ndim == 4:
-        dim_i, dim_j, dim_k, dim_filters = patch.shape
-
-        # apply periodic shuffling:
-        patch_ps = np.ndarray((dim_i * upsampling_rate,
-                               dim_j * upsampling_rate,
-                               dim_j * upsampling_rate,
-                               dim_filters // (upsampling_rate ** 3)), dtype='float64')
-
-        shuffle_indices = [(i, j, k) for k in xrange(upsampling_rate)
-                                     for j in xrange(upsampling_rate)
-                                     for i in xrange(upsampling_rate)]
-
-        no_channels = dim_filters / (upsampling_rate ** 3)
-
-        for c in xrange(dim_filters // (upsampling_rate ** 3)):
-            for (i, j, k) in shuffle_indices:
-                patch_ps[i::upsampling_rate, j::upsampling_rate, k::upsampling_rate, c] \
-                    = patch[:, :, :, np.mod(i, upsampling_rate) +
-                                     np.mod(j, upsampling_rate) * upsampling_rate +
-                                     np.mod(k, upsampling_rate) * (upsampling_rate**2) +
-                                     c * (upsampling_rate**3)]
-
-    elif patch.ndim == 5:  # apply periodic shuffling to a batch of examples.
-        batch_size, dim_i, dim_j, dim_k, dim_filters = patch.shape
-
-        # Apply reverse shuffling (optional):
-        shuffle_indices = [(i, j, k) for k in xrange(upsampling_rate)
-                                     for j in xrange(upsampling_rate)
-                                     for i in xrange(upsampling_rate)]
-
-        patch_ps = np.ndarray((batch_size,
-                               dim_i * upsampling_rate,
-                               dim_j * upsampling_rate,
-                               dim_j * upsampling_rate,
-                               dim_filters // (upsampling_rate ** 3)), dtype='float64')
-
-        no_channels = dim_filters // (upsampling_rate ** 3)
-
-        for c in xrange(dim_filters // (upsampling_rate ** 3)):
-            for (i, j, k) in shuffle_indices:
-                patch_ps[:, i::upsampling_rate, j::upsampling_rate, k::upsampling_rate, c] \
-                    = patch[:, :, :, :, np.mod(i, upsampling_rate) +
-                                        np.mod(j, upsampling_rate) * upsampling_rate +
-                                        np.mod(k, upsampling_rate) * (upsampling_rate**2) +
-                                        c * (upsampling_rate**3)]
-    return patch_ps
+    us = upsampling_rate
+    if patch.ndim not in (3, 4, 5):
+        raise ValueError('Only 3, 4 or 5 dimensional arrays handled.')
+    spatial = patch.shape[:-1] if patch.ndim != 5 else patch.shape[1:-1]
+    batch = patch.shape[:1] if patch.ndim == 5 else ()
+    nsp = len(spatial)
+    if patch.shape[-1] % us**nsp:
+        raise ValueError('Incompatible number of shuffled layers for upsampling')
+    channels = patch.shape[-1] // us**nsp
+
+    # split the channel axis into (c, .., j, i) and interleave the offsets
+    # with the spatial axes: (x, i, y, j, ..., c)
+    nb = len(batch)
+    view = patch.reshape(batch + spatial + (channels,) + (us,) * nsp)
+    order = list(range(nb))
+    for d in range(nsp):
+        order += [nb + d, patch.ndim + nsp - 1 - d]
+    order.append(nb + nsp)
+    view = view.transpose(order)
+
+    shape = batch + tuple(n * us for n in spatial) + (channels,)
+    if patch.ndim == 3 and channels == 1:
+        shape = shape[:-1]
+    if out is None:
+        out = np.empty(shape, dtype=patch.dtype)
+    elif out.shape != shape:
+        raise ValueError('Output array must have shape %s' % (shape,))
+    # splitting axes always gives a view, also of a strided out
+    out.reshape(view.shape)[...] = view
+    return out
 
 
 # Define new plotting functions:
@@ -0,0 +1,193 @@
+"""Per-subject manifests of precomputed facts about the training volumes.
+
+A manifest is a small JSON sidecar next to a subject's images holding
+what the preprocessing would otherwise scan the whole volumes for: the
+bounding box of the non-zero voxels and the clipping percentiles of each
+channel (see Data._preprocess), along with the image shape they are
+checked against. It records the size and modification time of the source
+files and is rebuilt when any of them changes.
+
+Manifests are built on demand by prepare_data, or ahead of time for a
+whole cohort, run from the repository root:
+    python -m common.subject_manifest --data_dir /SAN/vision/hcp/DCA_HCP.2013.3_Proc \
+        --subjects subjects.txt --inp_header 'dt_b1000_lowres_2_{:d}.nii'
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import numpy as np
+import common.data_utils as dutils
+from common.make_lowres import read_manifest
+from common.patch_sampler import clip_key
+
+# bumped whenever the content of the manifests changes (2: no foreground
+# voxel count)
+MANIFEST_VERSION = 2
+
+
+def manifest_name(inp_header, out_header, inp_channels, out_channels):
+    """File name of the manifest of a set of input/output channel files.
+    Each set (e.g. each upsampling rate) gets its own manifest."""
+    key = hashlib.sha1(repr((inp_header, out_header, list(inp_channels),
+                             list(out_channels))).encode('utf-8'))
+    return 'nsampler_manifest_' + key.hexdigest()[:12] + '.json'
+
+
+def file_stamps(data_dir_root, subpath, subject, header, channels):
+    """(file name, size, modification time) of each channel file of a subject."""
+    namepat = os.path.join(data_dir_root, subject, subpath, header)
+    stamps = []
+    for ch in channels:
+        filename = namepat.format(ch)
+        st = os.stat(filename)
+        stamps.append([os.path.basename(filename), st.st_size, int(st.st_mtime)])
+    return stamps
+
+
+def load_manifest(data_dir_root, subpath, subject, inp_header, out_header,
+                  inp_channels, out_channels):
+    """Loads the manifest of a subject.
+
+    Returns:
+        info (dict): the manifest, or None if there is none or it is stale
+    """
+    filename = os.path.join(data_dir_root, subject, subpath,
+                            manifest_name(inp_header, out_header,
+                                          inp_channels, out_channels))
+    if not os.path.isfile(filename):
+        return None
+    try:
+        with open(filename, 'r') as handle:
+            info = json.load(handle)
+    except ValueError:
+        return None
+    stamps = {'inp': file_stamps(data_dir_root, subpath, subject,
+                                 inp_header, inp_channels),
+              'out': file_stamps(data_dir_root, subpath, subject,
+                                 out_header, out_channels)}
+    if info.get('version') != MANIFEST_VERSION or info.get('files') != stamps:
+        return None
+    return info
+
+
+def build_manifest(data_dir_root, subpath, subject, inp_header, out_header,
+                   inp_channels, out_channels, percentiles=((0.1, 99.9),)):
+    """Scans the volumes of a subject and writes its manifest.
+
+    Args:
+        data_dir_root, subpath, subject: location of the subject's images
+        inp_header, out_header (str): name patterns of the channel files
+        inp_channels, out_channels (list): channel indices
+        percentiles (list): (tail, head) clipping percentiles to precompute
+
+    Returns:
+        info (dict): the manifest
+    """
+    subject_dir = os.path.join(data_dir_root, subject, subpath)
+    # stamped before loading, so that files changed meanwhile are rescanned
+    stamps = {'inp': file_stamps(data_dir_root, subpath, subject,
+                                 inp_header, inp_channels),
+              'out': file_stamps(data_dir_root, subpath, subject,
+                                 out_header, out_channels)}
+    inp, _ = dutils.load_series_nii(os.path.join(subject_dir, inp_header),
+                                    list(inp_channels), dtype='float32',
+                                    sanitise=True)
+    out, _ = dutils.load_series_nii(os.path.join(subject_dir, out_header),
+                                    list(out_channels), dtype='float32',
+                                    sanitise=True)
+    if inp.ndim == 3:
+        inp, out = inp[..., np.newaxis], out[..., np.newaxis]
+
+    start, stop = dutils.nonzero_box(inp, out)
+    clips = dict()
+    for tail_perc, head_perc in percentiles:
+        bounds = dict()
+        for name, img in (('inp', inp), ('out', out)):
+            tails, heads = dutils.mask_percentiles(img, img[..., 0] != 0,
+                                                   tail_perc, head_perc)
+            if tails is not None:
+                bounds[name] = [tails.tolist(), heads.tolist()]
+        clips[clip_key(tail_perc, head_perc)] = bounds
+    info = {'version': MANIFEST_VERSION,
+            'files': stamps,
+            'shape': list(inp.shape),
+            'box': [start.tolist(), stop.tolist()],
+            'clip': clips}
+
+    filename = os.path.join(subject_dir,
+                            manifest_name(inp_header, out_header,
+                                          inp_channels, out_channels))
+    tmpname = filename + '.%d' % os.getpid()
+    with open(tmpname, 'w') as handle:
+        json.dump(info, handle, indent=2, sort_keys=True)
+    os.rename(tmpname, filename)
+    return info
+
+
+def _build_manifest(args):
+    # module level, so that the pool can pickle it
+    subject, kwargs = args
+    build_manifest(subject=subject, **kwargs)
+    return subject
+
+
+def subject_manifests(data_dir_root, subpath, subjects, inp_header, out_header,
+                      inp_channels, out_channels, no_workers=4, rebuild=False):
+    """Manifests of several subjects, building the missing or stale ones in
+    a pool of processes.
+
+    Args:
+        subjects (list): subject ids
+        no_workers (int): number of subjects scanned in parallel
+        rebuild (bool): rebuild all the manifests
+        (others): as in build_manifest
+
+    Returns:
+        infos (list): the manifest of each subject
+    """
+    kwargs = dict(data_dir_root=data_dir_root, subpath=subpath,
+                  inp_header=inp_header, out_header=out_header,
+                  inp_channels=list(inp_channels),
+                  out_channels=list(out_channels))
+    load = lambda subject: load_manifest(subject=subject, **kwargs)
+    infos = [None if rebuild else load(subject) for subject in subjects]
+    missing = [subject for subject, info in zip(subjects, infos) if info is None]
+    if missing:
+        print('Building the manifests of %d subjects' % len(missing))
+        jobs = [(subject, kwargs) for subject in missing]
+        if no_workers <= 1 or len(missing) <= 1:
+            for job in jobs:
+                _build_manifest(job)
+        else:
+            pool = multiprocessing.Pool(min(no_workers, len(missing)))
+            try:
+                for subject in pool.imap_unordered(_build_manifest, jobs):
+                    print('Manifest done: ' + subject)
+            finally:
+                pool.close()
+                pool.join()
+        infos = [load(subject) for subject in subjects]
+    return infos
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='build the subject manifests')
+    parser.add_argument('--data_dir', type=str, default='/SAN/vision/hcp/DCA_HCP.2013.3_Proc', help='root directory of the subjects')
+    parser.add_argument('--subpath', type=str, default='T1w/Diffusion', help='subdirectory in each subject folder')
+    parser.add_argument('--subjects', type=str, required=True, help='file listing the subject ids, one per line')
+    parser.add_argument('--inp_header', type=str, default='dt_b1000_lowres_2_{:d}.nii', help='name pattern of the input channel files')
+    parser.add_argument('--out_header', type=str, default='dt_b1000_{:d}.nii', help='name pattern of the output channel files')
+    parser.add_argument('--channels', type=int, nargs=2, default=[3, 8], help='first and last channel index')
+    parser.add_argument('--no_workers', type=int, default=4, help='number of subjects scanned in parallel')
+    parser.add_argument('--rebuild', action='store_true', help='rebuild up-to-date manifests as well')
+    arg = parser.parse_args()
+
+    channels = list(range(arg.channels[0], arg.channels[1] + 1))
+    subject_manifests(arg.data_dir, arg.subpath, read_manifest(arg.subjects),
+                      arg.inp_header, arg.out_header, channels, channels,
+                      no_workers=arg.no_workers, rebuild=arg.rebuild)
@@ -0,0 +1,112 @@
+""" Precision of the reduced storage types of VolumeStore.
+
+The volumes mimic DTI tensor channels: values of 1e-3 to 1e-2 in magnitude
+(of either sign) inside a brain mask, zero outside, and a few outlier voxels
+ten times larger, which set the scale of the integer storage.
+
+Run from the repository root:
+    python -m pytest common/tests
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import unittest
+import numpy as np
+from common.patch_sampler import VolumeStore
+
+
+def dti_volumes(no_subjects=2, shape=(20, 22, 18), channels=6, seed=0):
+    rng = np.random.RandomState(seed)
+    volumes = []
+    for s in range(no_subjects):
+        sh = tuple(d + s for d in shape)
+        x, y, z = np.ogrid[:sh[0], :sh[1], :sh[2]]
+        mask = ((x - sh[0] / 2.) ** 2 / (0.4 * sh[0]) ** 2 +
+                (y - sh[1] / 2.) ** 2 / (0.4 * sh[1]) ** 2 +
+                (z - sh[2] / 2.) ** 2 / (0.4 * sh[2]) ** 2) < 1
+        vol = rng.uniform(1e-3, 1e-2, size=sh + (channels,))
+        vol *= rng.choice([-1, 1], size=vol.shape)
+        outliers = rng.rand(*vol.shape) < 1e-3
+        vol[outliers] = rng.uniform(-0.1, 0.1, size=np.count_nonzero(outliers))
+        volumes.append((vol * mask[..., np.newaxis]).astype('float32'))
+    return volumes
+
+
+def patch_centres(volumes, radius, scale=1, n=200, seed=1):
+    """ Random centres of patches within the volumes (see VolumeStore.gather) """
+    rng = np.random.RandomState(seed)
+    rows = []
+    for _ in range(n):
+        s = rng.randint(len(volumes))
+        rows.append([s] + [rng.randint(radius, d // scale - radius)
+                           for d in volumes[s].shape[:3]])
+    return np.array(rows, dtype=np.intp)
+
+
+def gather(volumes, dtype, pindlist, radius, scale=1, shuffle=1):
+    """ Patches gathered into a float32 batch buffer, as Data does """
+    store = VolumeStore([v.copy() for v in volumes], dtype=dtype)
+    out = np.empty((len(pindlist),) + store.patch_shape(radius, scale, shuffle),
+                   dtype='float32')
+    return store, store.gather(pindlist, radius, scale=scale, out=out,
+                               shuffle=shuffle)
+
+
+class TestStorageTypes(unittest.TestCase):
+
+    radius = 3
+
+    def setUp(self):
+        self.volumes = dti_volumes()
+        self.pindlist = patch_centres(self.volumes, self.radius)
+        _, self.ref = gather(self.volumes, 'float32', self.pindlist,
+                             self.radius)
+
+    def gather(self, dtype):
+        return gather(self.volumes, dtype, self.pindlist, self.radius)
+
+    def assert_errors(self, patches, ref, atol, rtol, max_rel_rms):
+        err = np.abs(patches.astype('float64') - ref)
+        bound = atol + rtol * np.abs(ref)
+        self.assertTrue(np.all(err <= bound),
+                        'max excess error %g' % (err - bound).max())
+        rel_rms = np.sqrt(np.mean(err ** 2) / np.mean(ref ** 2.))
+        self.assertLess(rel_rms, max_rel_rms)
+        # background voxels stay exactly zero:
+        self.assertTrue(np.all(patches[ref == 0] == 0))
+
+    def test_float32_is_exact(self):
+        _, patches = self.gather('float32')
+        np.testing.assert_array_equal(patches, self.ref)
+
+    def test_float16(self):
+        _, patches = self.gather('float16')
+        # rounding to 11 significant bits, subnormals below 2**-14:
+        self.assert_errors(patches, self.ref, atol=2. ** -25, rtol=2. ** -11,
+                           max_rel_rms=3e-4)
+
+    def test_int16(self):
+        store, patches = self.gather('int16')
+        # rounding to the nearest step of each channel's scale, which maps
+        # the largest magnitude (an outlier) to 32767:
+        maxabs = np.abs(np.concatenate(
+            [v.reshape(-1, v.shape[3]) for v in self.volumes])).max(axis=0)
+        np.testing.assert_allclose(store.scales, maxabs / 32767., rtol=1e-6)
+        self.assert_errors(patches, self.ref, atol=0.5 * store.scales * (1 + 1e-5),
+                           rtol=1e-6, max_rel_rms=5e-4)
+
+    def test_shuffled_hires(self):
+        # hi-res patches, reverse shuffled as they are gathered:
+        pindlist = patch_centres(self.volumes, 1, scale=2)
+        _, ref = gather(self.volumes, 'float32', pindlist, 1, 2, 2)
+        _, patches = gather(self.volumes, 'float16', pindlist, 1, 2, 2)
+        self.assert_errors(patches, ref, atol=2. ** -25, rtol=2. ** -11,
+                           max_rel_rms=3e-4)
+        store, patches = gather(self.volumes, 'int16', pindlist, 1, 2, 2)
+        self.assert_errors(patches, ref,
+                           atol=0.5 * np.repeat(store.scales, 8) * (1 + 1e-5),
+                           rtol=1e-6, max_rel_rms=5e-4)
+
+
+if __name__ == '__main__':
+    unittest.main()
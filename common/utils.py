@@ -9,6 +9,7 @@ import cPickle as pkl
 import numpy as np
 import tensorflow as tf
 from common.sr_utility import forward_periodic_shuffle, compute_CFA, compute_MD_and_FA
+from common.data_utils import clip_percentiles
 
 # FIXME: this is horrid
 import models
@@ -142,6 +143,7 @@ def name_patchlib(opt):
                opt['patchlib_idx'])
     nn_str += 'ts=%d_pl=%d_nrm=%s_smpl=%s_%03i'
     nn_body = nn_str % nn_var
+    if opt.get('streaming', False): nn_body += '_stream'
     return header+'_'+nn_body
 
 
@@ -715,14 +717,14 @@ def clip_image(img, bkgv=0.0, tail_perc=0.1, head_perc=99.9):
         back ground value is consistently given by bkgv.
 
     Args:
+        img (np.ndarray): 4d volume, clipped in place
+        bkgv (float): background value of the first channel
+        tail_perc (float): lower percentile
+        head_perc (float): upper percentile
     """
     assert img.ndim == 4
     brain_mask = img[..., 0] != bkgv # get the foreground voxels
-    for ch_idx in range(img.shape[-1]):
-        v_ch=img[...,ch_idx][brain_mask]
-        inp_perc_tail = np.percentile(v_ch, tail_perc)
-        inp_perc_head = np.percentile(v_ch, head_perc)
-        img[...,ch_idx][brain_mask]=np.clip(v_ch, inp_perc_tail, inp_perc_head)
+    clip_percentiles(img, brain_mask, tail_perc, head_perc) # in place
     return img
 
 